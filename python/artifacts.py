@@ -0,0 +1,111 @@
+"""
+Collection of test artifacts from the hosts. Remote files and the output of
+commands such as journalctl are registered while the test runs. At teardown,
+each host sends all of its artifacts in one compressed tar stream, with all
+hosts in parallel, and the streams are unpacked into the log directory.
+"""
+
+import functools
+import os
+import shlex
+import subprocess
+import threading
+
+from . import logfiles, parallel
+from .drbdtestlogger import log
+
+
+class Artifact(object):
+    def __init__(self, name, remote_path=None, cmd_string=None, keep_empty=True, fixup=None):
+        self.name = name
+        self.remote_path = remote_path
+        self.cmd_string = cmd_string
+        self.keep_empty = keep_empty
+        self.fixup = fixup
+
+    def script(self):
+        dest = '"$d"/' + shlex.quote(self.name)
+        if self.remote_path:
+            # Link rather than copy; tar follows the link
+            line = '[ -e {0} ] && ln -s {0} {1}'.format(shlex.quote(self.remote_path), dest)
+        else:
+            line = '( {} ) < /dev/null > {} 2> /dev/null'.format(self.cmd_string, dest)
+        if not self.keep_empty:
+            line += '; [ -s {0} ] || rm -f {0}'.format(dest)
+        return line
+
+
+class ArtifactCollector(object):
+    """ Artifacts per host which are collected into the log directory. """
+
+    def __init__(self, logdir):
+        self.logdir = logdir
+        self.artifacts = {}
+        # Artifacts may be added while they are collected
+        self.lock = threading.Lock()
+        # Collection may be started early, see Cluster.kernel_fatal
+        self.collect_lock = threading.Lock()
+
+    def add_file(self, host, remote_path, name, keep_empty=True, fixup=None):
+        """
+        Register a remote file. It is stored as "name" in the log directory.
+        Missing files are skipped.
+
+        :param fixup: called with the local path after unpacking, to rewrite
+            the file
+        """
+        self._add(host, Artifact(name, remote_path=remote_path, keep_empty=keep_empty, fixup=fixup))
+
+    def add_command(self, host, cmd, name, keep_empty=True):
+        """
+        Register a command, given as a list of strings, which is run at
+        collection time. Its output is stored as "name" in the log directory.
+        """
+        cmd_string = ' '.join(shlex.quote(str(x)) for x in cmd)
+        self._add(host, Artifact(name, cmd_string=cmd_string, keep_empty=keep_empty))
+
+    def _add(self, host, artifact):
+        with self.lock:
+            self.artifacts.setdefault(host, {})[artifact.name] = artifact
+
+    def script(self, artifacts):
+        lines = ['d=$(mktemp -d) || exit 1', 'trap \'rm -rf "$d"\' EXIT']
+        lines.extend(artifact.script() for artifact in artifacts.values())
+        lines.append('tar czhf - -C "$d" .')
+        return '\n'.join(lines) + '\n'
+
+    def collect_host(self, host):
+        """ Fetch the artifacts of one host and unpack them. """
+        with self.lock:
+            artifacts = dict(self.artifacts.get(host, {}))
+        if not artifacts:
+            return
+
+        log('{}: collecting {} artifact(s)'.format(host.name, len(artifacts)))
+        untar = subprocess.Popen(['tar', 'xzf', '-', '--no-overwrite-dir', '-C', self.logdir], stdin=subprocess.PIPE)
+        try:
+            host.run(['bash', '-c', self.script(artifacts)], stdout_sink=untar.stdin.write,
+                    ignore_netns=True, timeout=120)
+        finally:
+            untar.stdin.close()
+            returncode = untar.wait()
+        if returncode != 0:
+            raise RuntimeError('{}: unpacking artifacts failed ({})'.format(host.name, returncode))
+
+        for name, artifact in artifacts.items():
+            path = os.path.join(self.logdir, name)
+            if artifact.fixup and os.path.isfile(path):
+                artifact.fixup(path)
+            logfiles.compress_file(path)
+        with self.lock:
+            # Keep the artifacts which were added in the meantime
+            remaining = self.artifacts.get(host, {})
+            for name, artifact in artifacts.items():
+                if remaining.get(name) is artifact:
+                    del remaining[name]
+
+    def collect(self, hosts):
+        """ Fetch the artifacts of all hosts in parallel. """
+        with self.collect_lock:
+            parallel.run_parallel(
+                    [(host, functools.partial(self.collect_host, host)) for host in hosts])
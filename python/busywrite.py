@@ -1,5 +1,14 @@
 import json
-import os
+
+
+def strip_json_prefix(path):
+    """ Drop the non-JSON messages which some fio versions write before the JSON output. """
+    with open(path, 'rb') as f:
+        fio_out = f.read()
+    start = fio_out.find(b'{')
+    if start > 0:
+        with open(path, 'wb') as f:
+            f.write(fio_out[start:])
 
 
 class BusyWrite(object):
@@ -10,6 +19,7 @@ class BusyWrite(object):
         self._node = volume.node
         self._fio_pid = None
         self._fio_out_str = None
+        self._finished = False
 
     def start(self, fio_arg_str='',
               fio_base_args='--rw=randwrite --direct=1 ' +
@@ -29,8 +39,17 @@ class BusyWrite(object):
         fio_arg_str -- extra arguments to pass to fio
         fio_base_args -- arguments to pass to fio; defaults to writing busily for a long time
         """
-        self._output_filename = 'fio-{}-{}-async.json'.format(self._node.name, self._node.host.fio_count)
-        self._stderr_filename = 'fio-{}-{}-async-stderr'.format(self._node.name, self._node.host.fio_count)
+        fio_count = self._node.host.next_fio_count()
+        self._output_filename = 'fio-{}-{}-async.json'.format(self._node.name, fio_count)
+        self._stderr_filename = 'fio-{}-{}-async-stderr'.format(self._node.name, fio_count)
+        self._fio_out_str = None
+        self._finished = False
+
+        # The output files are collected into the log directory at cleanup
+        artifacts = self._node.resource.cluster.artifacts
+        artifacts.add_file(self._node.host, '/tmp/' + self._output_filename, self._output_filename,
+                fixup=strip_json_prefix)
+        artifacts.add_file(self._node.host, '/tmp/' + self._stderr_filename, self._stderr_filename)
 
         if self._node.host.is_linux_host():
             platform_args = '--ioengine=libaio '
@@ -45,8 +64,6 @@ class BusyWrite(object):
                 ' < /dev/null > /tmp/{} 2> /tmp/{} & echo $!'.format(self._output_filename, self._stderr_filename)]
         self._fio_pid = self._node.run(fio_cmd, return_stdout=True)
 
-        self._node.host.fio_count += 1
-
     def is_running(self):
         if self._fio_pid is None:
             return False
@@ -62,19 +79,13 @@ class BusyWrite(object):
         raise RuntimeError('unexpected output from running check: ' + running_str)
 
     def wait(self, timeout=None):
-        """ Wait for fio to terminate and collect results. """
+        """
+        Wait for fio to terminate. The results are collected at cleanup, or
+        when they are needed.
+        """
         self._node.run(['tail', '--pid={}'.format(self._fio_pid), '-f', '/dev/null'], timeout=timeout)
         self._fio_pid = None
-
-        self._fio_out_str = self._node.run(['cat', '/tmp/{}'.format(self._output_filename)], return_stdout=True)
-        # Some fio versions write non-json messages before the json output
-        self._fio_out_str = self._fio_out_str[self._fio_out_str.find('{'):]
-        with open(os.path.join(self._node.resource.cluster.logdir, self._output_filename), 'w') as output_file:
-            output_file.write(self._fio_out_str)
-
-        fio_stderr = self._node.run(['cat', '/tmp/{}'.format(self._stderr_filename)], return_stdout=True)
-        with open(os.path.join(self._node.resource.cluster.logdir, self._stderr_filename), 'w') as output_file:
-            output_file.write(fio_stderr)
+        self._finished = True
 
     def kill_jobs(self):
         if self._fio_pid is None:
@@ -90,7 +101,11 @@ class BusyWrite(object):
         self.wait()
 
     def get_write_kib(self):
-        if self._fio_out_str is None:
+        if not self._finished:
             raise RuntimeError('Wait for fio to stop first')
+        if self._fio_out_str is None:
+            fio_out = self._node.run(['cat', '/tmp/{}'.format(self._output_filename)], return_bytes=True)
+            # Some fio versions write non-json messages before the json output
+            self._fio_out_str = fio_out[fio_out.find(b'{'):].decode('utf-8')
         fio_output = json.loads(self._fio_out_str)
         return fio_output['jobs'][0]['write']['io_kbytes']
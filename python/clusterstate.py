@@ -0,0 +1,146 @@
+"""
+Live model of the DRBD object states in the cluster, maintained from the
+events2 records as they arrive. Reading a state does not consume any event
+positions, unlike waiting for an event. Example:
+
+if peer_device.state.peer_disk == 'UpToDate':
+    ...
+cluster.state.wait_until(lambda: all(pd.state.replication == 'Established'
+    for pd in resource.peer_devices))
+"""
+
+import contextlib
+import threading
+import time
+
+from lbpytest.logscan import TimeoutException
+
+state_actions = {'exists', 'create', 'change', 'destroy'}
+
+
+class ObjectState(object):
+    """
+    The current fields of one resource, device, connection or peer device.
+    Fields are read as attributes with underscores instead of dashes and are
+    None when they are unknown.
+    """
+
+    def __init__(self, cluster_state, key):
+        self._cluster_state = cluster_state
+        self._key = key
+        self._fields = {}
+        self._exists = False
+        # Incremented with every update
+        self.version = 0
+
+    def update(self, record):
+        if record.action == 'destroy':
+            self._exists = False
+            self._fields = {}
+        else:
+            self._exists = True
+            # Replace rather than update in place, readers may hold the old dict
+            self._fields = {**self._fields, **record.fields}
+        self.version += 1
+
+    def _touch(self):
+        accessed = getattr(self._cluster_state._local, 'accessed', None)
+        if accessed is not None:
+            accessed.add(self)
+
+    @property
+    def exists(self):
+        self._touch()
+        return self._exists
+
+    @property
+    def fields(self):
+        """ A copy of all current fields. """
+        self._touch()
+        return dict(self._fields)
+
+    def get(self, field, default=None):
+        self._touch()
+        return self._fields.get(field, default)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.get(name.replace('_', '-'))
+
+    def __repr__(self):
+        return '{} {}'.format(' '.join(str(part) for part in self._key if part is not None),
+                ' '.join('{}:{}'.format(key, value) for key, value in self._fields.items()))
+
+
+class ClusterState(object):
+    """ The states of all DRBD objects, kept up to date by an EventStore. """
+
+    def __init__(self, store):
+        self.store = store
+        self.states = {}
+        # Incremented with every update of any state
+        self.version = 0
+        self._local = threading.local()
+        store.add_listener(self._update)
+
+    def _update(self, record):
+        if record.action not in state_actions or record.obj == '-':
+            return
+        self.get(record.key()).update(record)
+        self.version += 1
+
+    def get(self, key):
+        """
+        Return the state for an EventRecord key. Unknown objects get an
+        empty state which is filled once events for them arrive.
+        """
+        state = self.states.get(key)
+        if state is None:
+            state = self.states.setdefault(key, ObjectState(self, key))
+        return state
+
+    def refresh(self):
+        """ Apply the events which have already arrived, without waiting. """
+        self.store.pump(0)
+
+    @contextlib.contextmanager
+    def _tracking(self):
+        accessed = set()
+        self._local.accessed = accessed
+        try:
+            yield accessed
+        finally:
+            self._local.accessed = None
+
+    def wait_until(self, predicate, timeout=30):
+        """
+        Wait until predicate returns a true value and return that value. The
+        predicate is evaluated again only when one of the states it read has
+        changed, or on any change if it did not read any state.
+
+        :raise TimeoutException: when the predicate is still false after
+            timeout seconds
+        """
+        deadline = time.time() + timeout
+        self.refresh()
+        while True:
+            with self._tracking() as accessed:
+                result = predicate()
+            if result:
+                return result
+
+            versions = [(state, state.version) for state in accessed]
+            cluster_version = self.version
+            while True:
+                if versions:
+                    if any(state.version != version for state, version in versions):
+                        break
+                elif self.version != cluster_version:
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutException('Timeout waiting for state: {}'.format(
+                        ', '.join(repr(state) for state, _ in versions) or 'no state read'))
+                self.store.pump(remaining)
@@ -0,0 +1,137 @@
+"""
+Run commands on a host through a long-lived agent process instead of
+starting a new SSH session and remote shell for every command.
+"""
+
+import base64
+import json
+import select
+import sys
+import threading
+import time
+
+from lbpytest.controlmaster import TimeoutException
+from lbpytest.incremental_line_split import IncrementalLineSplitter
+
+# Time to wait for a response beyond the command timeout
+response_grace_seconds = 10
+
+
+class CommandAgentUnavailable(Exception):
+    """ The agent cannot accept commands; the command was not sent. """
+
+
+class CommandAgentBusy(Exception):
+    """ The agent is running another command; the command was not sent. """
+
+
+class CommandAgent(object):
+    """
+    Client for the target helper "command-agent". The agent runs on the
+    target as a single SSH session and executes framed command requests
+    received on its stdin. The agent runs one command at a time; commands
+    issued while it is busy are refused with CommandAgentBusy, so that
+    concurrent commands do not wait for each other.
+    """
+
+    def __init__(self, ssh, agent_path, start_timeout=10):
+        self.ssh = ssh
+        self.lock = threading.Lock()
+        self.splitter = IncrementalLineSplitter()
+        self.lines = []
+        self.process = ssh.Popen('python3 -u {}'.format(agent_path))
+        try:
+            ready = self._read_response(start_timeout)
+        except Exception:
+            self.close()
+            raise
+
+        if not ready.get('ready'):
+            self.close()
+            raise RuntimeError('unexpected greeting from command agent: {}'.format(ready))
+
+    def _read_response(self, timeout):
+        deadline = time.time() + timeout if timeout else None
+        while not self.lines:
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                raise TimeoutException()
+            if not select.select([self.process.stdout], [], [], remaining)[0]:
+                raise TimeoutException()
+
+            data = self.process.stdout.read()
+            if not data:
+                raise EOFError('command agent terminated')
+            self.lines.extend(self.splitter.split(data))
+
+        return json.loads(self.lines.pop(0))
+
+    def run(self, cmd_string, stdin=False, stdout=None, stderr=None, timeout=None):
+        """
+        Run a command string through the agent. The arguments have the same
+        meaning as for SSH.run.
+
+        :returns: the exit code of the command
+        :raise CommandAgentUnavailable: when the command could not be sent
+        :raise CommandAgentBusy: when the agent is running another command
+        """
+        if not self.lock.acquire(blocking=False):
+            raise CommandAgentBusy()
+
+        try:
+            if self.process is None:
+                raise CommandAgentUnavailable()
+
+            request = {'cmd': cmd_string, 'stdin': None, 'timeout': timeout}
+            if stdin:
+                request['stdin'] = base64.b64encode(stdin.read().encode('utf-8')).decode('ascii')
+
+            try:
+                self.process.stdin.write((json.dumps(request) + '\n').encode('utf-8'))
+                self.process.stdin.flush()
+            except OSError as e:
+                self.process = None
+                raise CommandAgentUnavailable() from e
+
+            try:
+                response = self._read_response(
+                        timeout + response_grace_seconds if timeout else None)
+            except BaseException:
+                # The agent is out of sync now; do not use it again.
+                self._kill()
+                raise
+        finally:
+            self.lock.release()
+
+        stdout = stdout or sys.stdout
+        stderr = stderr or sys.stderr
+        stdout.write(base64.b64decode(response['stdout']).decode('utf-8', errors='backslashreplace'))
+        stderr.write(base64.b64decode(response['stderr']).decode('utf-8', errors='backslashreplace'))
+
+        if response['timeout']:
+            raise TimeoutException()
+
+        return response['returncode']
+
+    def interrupt(self):
+        """ Kill the agent from another thread, ending the running command. """
+        process = self.process
+        if process:
+            process.kill()
+
+    def _kill(self):
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def close(self):
+        """ Stop the agent. """
+        if self.process:
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
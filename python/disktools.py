@@ -5,6 +5,8 @@ import uuid
 
 def _drbdmeta_supports_uuid_options(node):
     """Return True if drbdmeta supports --initial-current-uuid and related UUID options."""
+    if node.host.facts:
+        return node.host.facts['drbdmeta_uuid_options']
     if not hasattr(node.host, '_drbdmeta_uuid_options'):
         out = node.host.run(
             ['bash', '-c',
@@ -243,9 +245,10 @@ class RawVolume(object):
         raise NotImplementedError('raw storage volume does not support fill_percentage')
 
     def _refresh_partitions(self):
-        self._host.run(['partx', '--update', self._backing_device])
-        self._host.run(['udevadm', 'trigger'])
-        self._host.run(['udevadm', 'settle'])
+        with self._host.batch() as batch:
+            batch.run(['partx', '--update', self._backing_device])
+            batch.run(['udevadm', 'trigger'])
+            batch.run(['udevadm', 'settle'])
 
 
 class ZfsPool(object):
@@ -274,9 +277,10 @@ class ZfsVolume(object):
         extra_args = ['-s'] if thin else []
         if discard_granularity is not None:
             extra_args += ['-o', 'volblocksize={}'.format(discard_granularity)]
-        self._host.run(['zfs', 'create', '-V', str(size), self._dataset_name] + extra_args)
-        self._host.run(['udevadm', 'trigger'])
-        self._host.run(['udevadm', 'settle'])
+        with self._host.batch() as batch:
+            batch.run(['zfs', 'create', '-V', str(size), self._dataset_name] + extra_args)
+            batch.run(['udevadm', 'trigger'])
+            batch.run(['udevadm', 'settle'])
 
     def volume_path(self):
         return self._zvol_path
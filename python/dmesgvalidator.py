@@ -0,0 +1,89 @@
+"""
+Validation of the kernel log while it is captured. The lines are checked as
+they arrive; only the lines which indicate a problem are kept, together with
+a few lines of context before and after each of them.
+"""
+
+import collections
+import re
+
+from . import fatal
+
+default_pattern = r'(BUG:|INFO:|ASSERTION|general protection fault)'
+
+
+class DmesgFinding(object):
+    """ A kernel log line which indicates a problem, with its context. """
+
+    def __init__(self, line, before):
+        self.line = line
+        self.before = before
+        self.after = []
+
+    def context(self):
+        """ The line with the lines around it, the line itself marked. """
+        return self.before + ['>>> ' + self.line] + self.after
+
+
+class DmesgValidator(object):
+    """
+    File-like object which checks each line written to it against pattern.
+
+    :param context: the number of lines kept before and after each matching
+        line
+    :param max_findings: the number of findings kept; further matching lines
+        are only counted
+    :param on_fatal: called with each line which matches fatal_pattern
+    """
+
+    def __init__(self, pattern=default_pattern, context=5, max_findings=20,
+            fatal_pattern=fatal.fatal_pattern, on_fatal=None):
+        self.regex = re.compile(pattern)
+        self.fatal_regex = re.compile(fatal_pattern)
+        self.on_fatal = on_fatal
+        self.context = context
+        self.max_findings = max_findings
+        self.findings = []
+        self.matches = 0
+        self.before = collections.deque(maxlen=context)
+        # Findings which still collect lines of context after them
+        self.open = []
+        self.partial = ''
+
+    @property
+    def ok(self):
+        return self.matches == 0
+
+    def write(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.check_line(line)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """ Check the last line if it was not terminated. """
+        if self.partial:
+            self.check_line(self.partial)
+            self.partial = ''
+
+    def check_line(self, line):
+        if self.open:
+            for finding in self.open:
+                finding.after.append(line)
+            self.open = [finding for finding in self.open if len(finding.after) < self.context]
+
+        if self.on_fatal and self.fatal_regex.search(line):
+            self.on_fatal(line)
+
+        if self.regex.search(line):
+            self.matches += 1
+            if len(self.findings) < self.max_findings:
+                finding = DmesgFinding(line, list(self.before))
+                self.findings.append(finding)
+                if self.context:
+                    self.open.append(finding)
+
+        self.before.append(line)
@@ -5,6 +5,7 @@
 # and the log messages with the resource name.
 
 import os
+import base64
 import errno
 import sys
 import re
@@ -16,22 +17,25 @@ import threading
 import traceback
 import socket
 import argparse
+import asyncio
 import subprocess
 import select
 import signal
 from subprocess import CalledProcessError
 import atexit
 from .ordered_set import OrderedSet
-from . import disktools, tls
-import io
+from . import artifacts, clusterstate, disktools, dmesgvalidator, eventdemux, events, eventstats, fatal, latency, logfiles, parallel, patterns, targethelpers, tls
 import fnmatch
+import functools
+from .commandagent import CommandAgent, CommandAgentBusy, CommandAgentUnavailable
 from .linuxplatformhelper import LinuxPlatformHelper
 from .windowsplatformhelper import WindowsPlatformHelper
 
 from io import StringIO
 
-from lbpytest.controlmaster import SSH
-from lbpytest.logscan import Logscan, InputStream
+from lbpytest.controlmaster import SSH, TimeoutException
+from lbpytest.incremental_line_split import IncrementalLineSplitter
+from lbpytest.logscan import NegativeMatchException
 from . import drbdtestlogger
 
 
@@ -218,10 +222,22 @@ class Cleanup(object):
         if etype == subprocess.CalledProcessError and hasattr(value, 'output') and value.output is not None:
             log(value.output.decode(encoding='utf-8', errors='backslashreplace'))
         traceback.print_exception(etype, value, tb, file=drbdtestlogger.logstream)
+        drbdtestlogger.logstream.sync()
         global uncaught_exception
         uncaught_exception = { 'exc_type': etype, 'exc_value': value, 'exc_tb': tb }
 
 
+def flush_logs_on_signal(signum, frame):
+    """
+    Signal handler which writes out the buffered logs and then terminates
+    the process by the signal, as without the handler.
+    """
+    drbdtestlogger.logstream.sync()
+    logfiles.flush_all()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
 def first(iterable):
     return next(iter(iterable))
 
@@ -266,6 +282,77 @@ class Collection(object):
         # FIXME: It should be possible to set the attribute in the class as well.
         return func
 
+    def parallel(self, max_workers=None):
+        """
+        Return a view of this collection which calls member functions
+        concurrently instead of one member after the other. Example:
+
+        resource.nodes.parallel().run(['true'])
+
+        The calls return the list of the members' return values. If a
+        member call fails, its exception is raised after all calls have
+        finished; if several fail, a parallel.ParallelError naming each
+        failing member is raised instead, see parallel.run_parallel.
+
+        Event waits are serialized, so the view is best suited for commands
+        which do not wait for events.
+        """
+        return ParallelCollection(self, max_workers)
+
+    def find_events(self, **query):
+        """
+        Return the recorded events2 records of all members which match query,
+        ordered by their arrival. See events.EventStore.find for the query
+        arguments. Example:
+
+        resource.peer_devices.find_events(replication='Established')
+        """
+        if not self.members:
+            return []
+        store = first(self.members).resource.cluster.event_store
+        store.require('find_events')
+        store.pump()
+        records = [record for member in self.members
+            for record in store.find(**member.event_query(), **query)]
+        return sorted(records, key=lambda record: record.seq)
+
+    def expect(self, after=None, **fields):
+        """
+        Return a condition which is satisfied once each member has an
+        events2 record with the given fields. Wait for conditions with
+        Cluster.wait_all or Cluster.wait_any. Example:
+
+        cluster.wait_all([
+            resource.connections.expect(connection='Connected'),
+            resource.peer_devices.expect(replication='Established')])
+
+        Only records which arrive after the condition was created count,
+        so create the conditions before triggering the events. The
+        resource's forbidden patterns apply while waiting.
+
+        :param after: count records after this EventStore cursor instead
+        """
+        resource = first(self.members).resource
+        store = resource.cluster.event_store
+        store.require('expect')
+        store.pump()
+        condition = events.EventCondition([member.event_query() for member in self.members], fields,
+                after=store.cursor() if after is None else after,
+                forbidden=resource.forbidden_patterns,
+                description='{} {}'.format(self, ' '.join(
+                    '{}={}'.format(key, value) for key, value in fields.items())))
+        store.hold(condition)
+        return condition
+
+    async def aevent(self, *args, **kwargs):
+        """
+        Coroutine variant of event(). The wait runs in a worker thread so
+        that other coroutines can make progress meanwhile. Event waits are
+        still serialized with each other.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.event, *args, **kwargs))
+
     @staticmethod
     def property(collection, name):
         """ Define collection.property as the union of all
@@ -325,6 +412,29 @@ class Collection(object):
         return member
 
 
+class ParallelCollection(object):
+    """ Call a function of all members of a collection concurrently. """
+
+    def __init__(self, collection, max_workers=None):
+        self.collection = collection
+        self.max_workers = max_workers
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection.cls, name)
+        if not callable(attr):
+            raise AttributeError(name)
+
+        def func(*args, **kwargs):
+            return parallel.run_parallel(
+                    [(member, functools.partial(getattr(member, name), *args, **kwargs))
+                        for member in self.collection.members],
+                    max_workers=self.max_workers)
+        return func
+
+    def __repr__(self):
+        return 'parallel({})'.format(self.collection)
+
+
 class Nodes(Collection):
     def __init__(self, members=[]):
         super(Nodes, self).__init__(Node, members)
@@ -357,10 +467,18 @@ class Nodes(Collection):
         for node in self.members:
             node.run(*args, **kwargs)
 
+    async def arun(self, *args, **kwargs):
+        """ Coroutine variant of run(). Runs the command on all our nodes concurrently. """
+        return await asyncio.gather(*(node.arun(*args, **kwargs) for node in self.members))
+
     def drbdadm(self, *args, **kwargs):
         for node in self.members:
             node.drbdadm(*args, **kwargs)
 
+    async def adrbdadm(self, *args, **kwargs):
+        """ Coroutine variant of drbdadm(). Runs drbdadm on all our nodes concurrently. """
+        return await asyncio.gather(*(node.adrbdadm(*args, **kwargs) for node in self.members))
+
     def up(self, extra_options=[]):
         # the order of disk/connection setup isn't strictly defined.
         # make sure that a defined order is seen, so that event matching works.
@@ -530,6 +648,10 @@ class Volumes(Collection):
         for v in self:
             v.fio(*args, **kwargs)
 
+    async def afio(self, *args, **kwargs):
+        """ Coroutine variant of fio(). Runs fio on all the volumes concurrently. """
+        return await asyncio.gather(*(v.afio(*args, **kwargs) for v in self))
+
     def suspend(self):
         for v in self:
             v.suspend()
@@ -683,7 +805,8 @@ class Cluster(object):
     In LINSTOR this is roughly equivalent to the "controller".
     """
 
-    def __init__(self, job, logdir, drbd_version, drbd_version_other, resource_name, transport, tls):
+    def __init__(self, job, logdir, drbd_version, drbd_version_other, resource_name, transport, tls,
+            event_store=False):
         self.job = job
         self.logdir = logdir
         self.drbd_version = drbd_version
@@ -694,15 +817,47 @@ class Cluster(object):
         self.hosts = []
         self.resources = []
         self.logscan_events = None
+        # Unconsumed Logscan lines kept per host, see set_event_retention
+        self.event_lines_retention = None
+        # Logscan is not thread safe; serialize waits from parallel calls.
+        self.logscan_lock = threading.Lock()
+        # Interrupts waits and commands on fatal kernel messages, see fatal
+        self.interrupt = fatal.Interrupt()
+        # Dumps the task stacks and collects the artifacts, see kernel_fatal
+        self.fatal_thread = None
+        # Whether to abort the test on the first fatal kernel message
+        self.fail_fast = True
+        # Parsed events2 records, fed while the event streams are read if
+        # event_store is set
+        self.event_store = events.EventStore(lock=self.logscan_lock, enabled=event_store)
+        self.event_store.interrupt = self.interrupt
+        # Current state of all DRBD objects, see clusterstate
+        self.state = clusterstate.ClusterState(self.event_store)
+        # Time series of the events2 statistics, see eventstats
+        self.statistics = eventstats.StatisticsRecorder(self.event_store, logdir)
+        # Latency from drbdadm commands to their events, see latency
+        self.latency = latency.LatencyRecorder(self.event_store, logdir)
         self.selinux_debug = False
+        # Seconds between the forwarded statistics-only events per object,
+        # see target/events-filter; None forwards all events unfiltered
+        self.events_stats_interval = None
+        # Remote files which are fetched into the log directory at cleanup
+        self.artifacts = artifacts.ArtifactCollector(logdir)
         atexit.register(self.cleanup)
 
     def cleanup(self):
+        self._end_fatal()
+        try:
+            self.artifacts.collect(self.hosts)
+        except Exception as e:
+            log('Collecting artifacts failed: {!r}'.format(e))
         if not skip_cleanup:
             for host in self.hosts:
                 host.cleanup()
         for host in self.hosts:
             host.cleanup_framework()
+        self.statistics.close()
+        self.latency.write()
         # The atexit cleanup handlers may spam the output.
         # I'd still like to have a clear indication about "test failed"
         # as the last line on stderr.
@@ -714,6 +869,53 @@ class Cluster(object):
                 file=drbdtestlogger.logstream)
         # else: we cannot be sure about the exit code, so don't claim "Success".
 
+    def measure_clock_offsets(self):
+        """
+        Measure the clock offsets of all hosts and write them to
+        clock-offsets.json in the log directory, see timeline.
+        """
+        parallel.run_parallel(
+                [(host, functools.partial(self.latency.clock_offset, host)) for host in self.hosts])
+        self.latency.write_clock_offsets()
+
+    def kernel_fatal(self, host, line):
+        """
+        Called with each fatal kernel message of host. Interrupts the waits
+        and commands of the test with KernelFatalError, dumps the kernel
+        stacks of all tasks on host and collects the artifacts.
+        """
+        if not self.fail_fast or not self.interrupt.trigger('{}: {}'.format(host.name, line)):
+            return
+        log('{}: fatal kernel message, aborting test: {}'.format(host.name, line))
+
+        def dump_and_collect():
+            try:
+                # The stacks appear in the kernel log
+                host.ssh.run('echo t > /proc/sysrq-trigger', stdout=drbdtestlogger.logstream,
+                        stderr=drbdtestlogger.logstream, timeout=10)
+            except Exception as e:
+                log('{}: dumping the task stacks failed: {}'.format(host.name, e))
+            try:
+                self.artifacts.collect(self.hosts)
+            except Exception as e:
+                log('Collecting artifacts failed: {!r}'.format(e))
+
+        # Leave the kernel log thread free to capture the stack dump
+        self.fatal_thread = threading.Thread(target=dump_and_collect)
+        self.fatal_thread.start()
+
+    def _end_fatal(self):
+        """
+        Wait for the work started by kernel_fatal, which uses the SSH
+        connections, and clear the interrupt once the test has seen it so
+        that the waits and commands of the cleanup can run.
+        """
+        if self.fatal_thread:
+            self.fatal_thread.join()
+            self.fatal_thread = None
+        if self.interrupt.raised:
+            self.interrupt.reset()
+
     def teardown(self, validate_dmesg=True):
         """
         Tear down test infrastructure. That is, remove the DRBD module and validate
@@ -722,6 +924,7 @@ class Cluster(object):
         This should be called at the end of a successful test run. General
         cleanup is performed by functions registered with "atexit".
         """
+        self._end_fatal()
         ok = True
         for host in self.hosts:
             host.rmmod()
@@ -736,24 +939,148 @@ class Cluster(object):
         for host in self.hosts:
             logscan_inputs[host.name] = host.listen_to_events()
 
-        self.logscan_events = Logscan(logscan_inputs, timeout=30)
+        for input in logscan_inputs.values():
+            input.max_lines = self.event_lines_retention
+
+        self.logscan_events = eventdemux.TrackingLogscan(logscan_inputs, timeout=30,
+                consumed=self._consumed_events, interrupt=self.interrupt)
+        self.event_store.attach(logscan_inputs)
+        for resource in self.resources:
+            self._attach_event_views(resource)
         self.logscan([r'exists -'],
                 {host.name: [[]] for host in self.hosts},
                 word_boundary=False)
 
+    def _attach_event_views(self, resource):
+        """ Give resource its own Logscan over its lines of the host streams. """
+        views = {label: input.add_view(resource.name) for label, input in self.logscan_events.inputs.items()}
+        resource.logscan_events = eventdemux.ViewLogscan(views, self.event_store.pump_locked, timeout=30,
+                consumed=self._consumed_resource_events, interrupt=self.interrupt)
+
+    def _consumed_events(self, label, number):
+        self.logscan_events.inputs[label].discard_views_through(number)
+
+    def _consumed_resource_events(self, label, number):
+        self.logscan_events.inputs[label].discard_through(number)
+
+    def set_event_retention(self, max_records, max_samples=None):
+        """
+        Bound the events2 history kept in memory, for long running tests.
+        At most about max_records parsed records and, per host, as many
+        unconsumed lines for event() waits are kept in memory. Older
+        unconsumed lines are moved to a temporary file and are still
+        matched by the waits. Older records are discarded unless a pending
+        condition still needs them. The events-<host> files in the log
+        directory still contain all events.
+
+        :param max_samples: the number of statistics samples kept per
+            object; the stats-<host>.csv files still contain all samples
+        """
+        self.event_lines_retention = max_records
+        self.event_store.max_records = max_records
+        self.statistics.max_samples = max_samples
+        if self.logscan_events:
+            for input in self.logscan_events.inputs.values():
+                input.max_lines = max_records
+
+    def checkpoint(self):
+        """
+        Declare that the events which have arrived so far are not needed any
+        more. Subsequent waits only match events which arrive after the
+        checkpoint, except for conditions created by expect() before it.
+        """
+        with self.logscan_lock:
+            if self.logscan_events:
+                for input in self.logscan_events.inputs.values():
+                    input.discard_views_through(input.line_number)
+                    input.discard_through(input.line_number)
+        evicted = self.event_store.checkpoint()
+        log('Checkpoint: discarded {} event record(s)'.format(evicted))
+
     def logscan(self, yes=[], filters=[], no=[], always_no=[], **kwargs):
         """ Wait for events to occur. """
+        return self._logscan(self.logscan_events, yes, filters, no, always_no, **kwargs)
+
+    def _logscan(self, logscan_events, yes, filters, no, always_no, **kwargs):
         if isinstance(no, str):
             no = [no]
+        wordwise = not 'word_boundary' in kwargs or kwargs['word_boundary']
+
+        # Match the forbidden patterns as one alternation instead of one
+        # regex per pattern
+        always_no_alternation = []
+        if isinstance(always_no, OrderedSet) and always_no:
+            always_no_alternation = [patterns.set_alternation(always_no)]
+        elif always_no:
+            always_no_alternation = [patterns.alternation(always_no)]
+
+        with self.logscan_lock:
+            try:
+                return logscan_events.event(
+                        yes=yes,
+                        no=no,
+                        always_no=always_no_alternation,
+                        filters=filters,
+                        wordwise=wordwise,
+                        timeout=kwargs.get('timeout'),
+                        verbose_out=drbdtestlogger.logstream)
+            except NegativeMatchException as e:
+                raise self._explain_negative_match(e, always_no_alternation, always_no, wordwise)
+
+    def _explain_negative_match(self, e, always_no_alternation, always_no, wordwise):
+        """ Name the forbidden pattern which matched rather than the whole alternation. """
+        m = re.match(r"Unexpected pattern '(.*)' matches at (.*):(\d+)$", str(e), re.DOTALL)
+        text = getattr(e, 'text', None)
+        if not m or [m.group(1)] != always_no_alternation or text is None:
+            return e
+        pattern = patterns.matching_pattern(always_no, text, wordwise)
+        if not pattern:
+            return e
+        return NegativeMatchException("Unexpected pattern '{}' matches at {}:{}".format(
+            pattern, m.group(2), m.group(3)))
+
+    def wait_all(self, conditions, timeout=None):
+        """
+        Wait until all conditions, as returned by expect(), are satisfied,
+        regardless of the order of their events.
+
+        :returns: for each condition, the list of matching records, one per
+            member. The records carry the host timestamps of the events.
+        """
+        return self._wait_conditions(self.event_store.wait_all, conditions, timeout)
+
+    def wait_any(self, conditions, timeout=None):
+        """
+        Wait until one of the conditions, as returned by expect(), is
+        satisfied.
 
-        return self.logscan_events.event(
-                yes=yes,
-                no=no,
-                always_no=always_no,
-                filters=filters,
-                wordwise=not 'word_boundary' in kwargs or kwargs['word_boundary'],
-                timeout=kwargs.get('timeout'),
-                verbose_out=drbdtestlogger.logstream)
+        :returns: (index, records) of the satisfied condition
+        """
+        return self._wait_conditions(self.event_store.wait_any, conditions, timeout)
+
+    def _wait_conditions(self, wait, conditions, timeout):
+        log('Waiting for events {}'.format('; '.join(repr(condition) for condition in conditions)))
+        result = wait(conditions, timeout=30 if timeout is None else timeout)
+        for condition in conditions:
+            for record in condition.records:
+                if record is not None:
+                    log('Condition {} matches at {}:{}'.format(condition, record.host, record.line))
+        return result
+
+    def gather(self, *aws):
+        """
+        Run coroutines concurrently in an event loop and return their results
+        in order. Example:
+
+        cluster.gather(
+            node_a.volumes[0].afio(fio_write_args),
+            node_b.adrbdadm(['disconnect', resource.name]),
+            node_c.aevent(r'connection .* connection:StandAlone'))
+        """
+        async def gather_all():
+            return await asyncio.gather(*aws)
+
+        return asyncio.run(gather_all())
 
     def validate_drbd_versions(self):
         """
@@ -783,15 +1110,23 @@ class Cluster(object):
             raise RuntimeError("Differing git hashes found for DRBD version '{}': {}".format(self.drbd_version, git_hashes))
 
     def write_drbd_versions_meta(self, f):
-        data = {}
-        for i, host in enumerate(self.hosts):
+        def installed_package(host):
+            if host.facts:
+                # None when drbd is compiled into the kernel, see below
+                return host.facts['drbd_package'] or ''
             try:
-                pkg = host.run_helper('installed-drbd-package', return_stdout=True)
+                return host.run_helper('installed-drbd-package', return_stdout=True)
             except CalledProcessError:
                 # when drbd is compiled into the kernel, there will be no drbd
                 # package installed and the helper will fail. just ignore this
                 # condition and return an empty package.
-                pkg = ''
+                return ''
+
+        packages = parallel.run_parallel(
+                [(host, functools.partial(installed_package, host)) for host in self.hosts])
+
+        data = {}
+        for host, pkg in zip(self.hosts, packages):
             data[host.name] = {
                 'version': host.drbd_version,
                 'git_hash': host.drbd_git_hash,
@@ -812,6 +1147,8 @@ class Cluster(object):
                     node0.connections.add(Connection(node0, node1))
 
         self.resources.append(resource)
+        if self.logscan_events:
+            self._attach_event_views(resource)
         return resource
 
     def create_storage_pool(self, thin=False, discard_granularity=None):
@@ -846,6 +1183,8 @@ class Resource(object):
         self.num_volumes = 0
         self.transport = transport
         self.tls = tls
+        # The waits of this resource, over its lines of the event streams
+        self.logscan_events = None
         self.forbidden_patterns = OrderedSet()
         self.forbidden_patterns.update([
             r'connection:Timeout',
@@ -857,6 +1196,18 @@ class Resource(object):
     def __repr__(self):
         return self.name
 
+    def cluster_state(self, host, obj, resource, peer_node_id, volume):
+        """ Return the current state of an object, applying any pending events first. """
+        self.cluster.event_store.require('state')
+        self.cluster.state.refresh()
+        return self.cluster.state.get((host, obj, resource, peer_node_id, volume))
+
+    def statistics_series(self, host, obj, resource, peer_node_id, volume):
+        """ Return the statistics time series of an object, including any pending events. """
+        self.cluster.event_store.require('statistics')
+        self.cluster.event_store.pump()
+        return self.cluster.statistics.series(host, obj, resource, peer_node_id, volume)
+
     def next_volume(self):
         volume = self.num_volumes
         self.num_volumes += 1
@@ -969,15 +1320,11 @@ class Resource(object):
         """
         Wait for events to occur.
 
-        Warning: Resource.forbidden_patterns applies to log lines for all
-        resources.
+        Only the lines of this resource and lines without a resource name
+        are scanned, see eventdemux. Resource.forbidden_patterns applies to
+        these lines.
         """
-        # Only add resource name filter if there is more than one resource to keep the logs clean
-        if len(self.cluster.resources) > 1:
-            filters = {node_name: [[r'name:{}'.format(self.name)] + filter_set for filter_set in node_filters]
-                    for node_name, node_filters in filters.items()}
-
-        return self.cluster.logscan(yes, filters,
+        return self.cluster._logscan(self.logscan_events, yes, filters,
                 no, self.forbidden_patterns, **kwargs)
 
     def up(self, extra_options=[]):
@@ -1107,6 +1454,20 @@ class Volume(object):
         return self.node.resource
     resource = property(get_resource)
 
+    def event_query(self):
+        """ Return the EventStore query arguments for this volume's events. """
+        return dict(host=self.node.host.name, obj='device', resource=self.resource.name,
+                peer_node_id=None, volume=self.volume)
+
+    @property
+    def state(self):
+        """ The current state of this device, for example volume.state.disk """
+        return self.resource.cluster_state(**self.event_query())
+
+    def statistics(self):
+        """ The events2 statistics of this device as an eventstats.TimeSeries """
+        return self.resource.statistics_series(**self.event_query())
+
     def get_peer_devices(self):
         peer_devices = PeerDevices()
         for connection in self.node.connections:
@@ -1144,6 +1505,12 @@ class Volume(object):
     def event(self, *args, **kwargs):
         return Volumes([self]).event(*args, **kwargs)
 
+    async def aevent(self, *args, **kwargs):
+        return await Volumes([self]).aevent(*args, **kwargs)
+
+    def expect(self, *args, **kwargs):
+        return Volumes([self]).expect(*args, **kwargs)
+
     def resize(self, size, zero_out=False):
         # TODO: metadata-resize?
         if zero_out:
@@ -1181,6 +1548,10 @@ class Volume(object):
         """
         return self.node.fio_file(self.device(), *args, **kwargs)
 
+    async def afio(self, *args, **kwargs):
+        """ Coroutine variant of fio(). """
+        return await self.node.afio_file(self.device(), *args, **kwargs)
+
     def dmsetup(self, cmd):
         dm_name = '%s-%s' % (self.node.host.volume_group.replace('-', '--'),
                              self.disk_lv.replace('-', '--'))
@@ -1241,6 +1612,20 @@ class Connection(object):
         return self.nodes[0].resource
     resource = property(get_resource)
 
+    def event_query(self):
+        """ Return the EventStore query arguments for this connection's events. """
+        return dict(host=self.nodes[0].host.name, obj='connection', resource=self.resource.name,
+                peer_node_id=self.nodes[1].id, volume=None)
+
+    @property
+    def state(self):
+        """ The current state of this connection, for example connection.state.connection """
+        return self.resource.cluster_state(**self.event_query())
+
+    def statistics(self):
+        """ The events2 statistics of this connection as an eventstats.TimeSeries """
+        return self.resource.statistics_series(**self.event_query())
+
     def __repr__(self):
         # return '%s:%s:%s' % (self.nodes[0].resource, self.nodes[0].name, self.nodes[1].name)
         return '%s:%s' % (self.nodes[0].name, self.nodes[1].name)
@@ -1257,6 +1642,12 @@ class Connection(object):
     def event(self, *args, **kwargs):
         return Connections([self]).event(*args, **kwargs)
 
+    async def aevent(self, *args, **kwargs):
+        return await Connections([self]).aevent(*args, **kwargs)
+
+    def expect(self, *args, **kwargs):
+        return Connections([self]).expect(*args, **kwargs)
+
     def connect(self, *args, **kwargs):
         return Connections([self]).connect(*args, **kwargs)
 
@@ -1297,6 +1688,20 @@ class PeerDevice(object):
         return self.connection.resource
     resource = property(get_resource)
 
+    def event_query(self):
+        """ Return the EventStore query arguments for this peer device's events. """
+        return dict(host=self.connection.nodes[0].host.name, obj='peer-device', resource=self.resource.name,
+                peer_node_id=self.connection.nodes[1].id, volume=self.volume.volume)
+
+    @property
+    def state(self):
+        """ The current state of this peer device, for example peer_device.state.replication """
+        return self.resource.cluster_state(**self.event_query())
+
+    def statistics(self):
+        """ The events2 statistics of this peer device as an eventstats.TimeSeries """
+        return self.resource.statistics_series(**self.event_query())
+
     def __repr__(self):
         return '%s:%s' % (self.connection, self.volume.volume)
 
@@ -1310,6 +1715,12 @@ class PeerDevice(object):
     def event(self, *args, **kwargs):
         return PeerDevices([self]).event(*args, **kwargs)
 
+    async def aevent(self, *args, **kwargs):
+        return await PeerDevices([self]).aevent(*args, **kwargs)
+
+    def expect(self, *args, **kwargs):
+        return PeerDevices([self]).expect(*args, **kwargs)
+
     def peer_device_options(self, opts=[]):
         PeerDevices([self]).peer_device_options(opts)
 
@@ -1353,9 +1764,15 @@ class AutoPromote(object):
 class ConfigBlock(object):
     INDENT = "     "
 
+    # The stack of open blocks is per thread, so that configurations for
+    # different nodes can be generated concurrently.
     _glob = threading.local()
-    _glob.stack = ["top"]
-    _stack = _glob.stack
+
+    @property
+    def _stack(self):
+        if not hasattr(self._glob, 'stack'):
+            self._glob.stack = ["top"]
+        return self._glob.stack
 
     def __init__(self, parent=None, fh=None, fn=None, t="", dest_fn=None):
         self.parent = parent
@@ -1410,6 +1827,105 @@ class ConfigBlock(object):
         self.write_no_indent(content)
 
 
+class BatchCommand(object):
+    """ A command queued in a Batch, and its result once the batch has run. """
+
+    def __init__(self, cmd, cmd_string, catch, return_stdout):
+        self.cmd = cmd
+        self.cmd_string = cmd_string
+        self.catch = catch
+        self.return_stdout = return_stdout
+        # returncode stays None if the command was not run because an earlier
+        # command of the batch failed
+        self.returncode = None
+        self.stdout = None
+        self.stderr = None
+
+    def __repr__(self):
+        return self.cmd_string
+
+
+class Batch(object):
+    """
+    Commands which are sent to a host in a single script, so that they only
+    pay for one SSH round trip. The commands run in order. The batch stops
+    at the first failing command unless that command was queued with
+    catch=True. The semantics of catch and return_stdout are the same as for
+    Host.run, applied per command.
+    """
+
+    def __init__(self, host, timeout=None):
+        self.host = host
+        self.timeout = timeout
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+
+    def run(self, cmd, quote=True, catch=False, return_stdout=False, env={}, ignore_netns=False):
+        """
+        Queue a command. See Host.run for documentation of the arguments.
+
+        :returns: a BatchCommand which holds the result once the batch has run
+        """
+        cmd_string = self.host.cmd_string(cmd, quote=quote, ignore_netns=ignore_netns)
+        if env:
+            cmd_string = SSH.inline_env(cmd_string, env)
+        command = BatchCommand(cmd, cmd_string, catch, return_stdout)
+        self.commands.append(command)
+        return command
+
+    def script(self):
+        lines = ['d=$(mktemp -d) || exit 1', 'trap \'rm -rf "$d"\' EXIT']
+        for command in self.commands:
+            lines.append('( {} ) < /dev/null > "$d/out" 2> "$d/err"; rc=$?'.format(command.cmd_string))
+            # One line per command: exit code, stdout and stderr
+            lines.append('echo "$rc $(base64 -w0 < "$d/out") $(base64 -w0 < "$d/err")"')
+            if not command.catch:
+                lines.append('[ $rc -eq 0 ] || exit 0')
+        return '\n'.join(lines) + '\n'
+
+    def execute(self):
+        """ Run the queued commands. Called when the context manager exits. """
+        if not self.commands:
+            return
+
+        for command in self.commands:
+            log(self.host.name + ': ' + command.cmd_string)
+
+        out = StringIO()
+        result = self.host.execute('bash -s', stdin=StringIO(self.script()),
+                stdout=out, stderr=drbdtestlogger.logstream, timeout=self.timeout)
+        if result != 0:
+            raise CalledProcessError(result, 'batch on {}'.format(self.host.name))
+
+        def decode(data):
+            return base64.b64decode(data).decode('utf-8', errors='backslashreplace')
+
+        for command, line in zip(self.commands, out.getvalue().splitlines()):
+            returncode, stdout, stderr = line.split(' ')
+            command.returncode = int(returncode)
+            command.stdout = decode(stdout)
+            command.stderr = decode(stderr)
+
+            if command.return_stdout:
+                command.stdout = command.stdout.strip()
+            else:
+                drbdtestlogger.logstream.write(command.stdout)
+            drbdtestlogger.logstream.write(command.stderr)
+
+            if command.returncode != 0:
+                if command.catch:
+                    print('error: {} failed ({})'.format(command.cmd[0], command.returncode),
+                            file=drbdtestlogger.logstream)
+                else:
+                    raise CalledProcessError(command.returncode, command.cmd_string)
+
+
 class Host():
     """
     A host system where DRBD runs.
@@ -1418,7 +1934,7 @@ class Host():
     """
 
     def __init__(self, cluster, name, volume_group, storage_backend, backing_device,
-                 first_port=7789, multi_paths=None, netns=None, ssh_config=None):
+                 first_port=7789, multi_paths=None, netns=None, ssh_config=None, command_agent=False):
         self.cluster = cluster
         self.name = name
         self.port = first_port
@@ -1430,35 +1946,88 @@ class Host():
             log('Could not start SSH connection for host {}:\n{}'.format(name, e.stderr.decode('utf-8')))
             raise
 
+        # The events2 process, see listen_to_events
+        self.events = None
         self.events_file = None
-        self.fio_count = 0
-        self.minors = 0
-        self.storage_pool = None
-        self.volume_group = volume_group
-        self.has_other_version = False
-        self.platform_helper = self.get_platform_helper()
-        self.read_drbd_version()
+        # Set before the first command, see execute
+        self.command_agent = None
+        self.dmesg_process = None
+        self.dmesg_thread = None
+        self.dmesg_out_file = None
 
-        if self.drbd_version_tuple < (9, 0, 0):
-            hostname_cmd = ['hostname']
-        else:
-            hostname_cmd = ['hostname', '-f']
-        self.hostname = self.run(hostname_cmd, return_stdout=True)
+        # The host is only cleaned up by the cluster once it has come up
+        try:
+            self.fio_count = 0
+            self.fio_count_lock = threading.Lock()
+            self.minors = 0
+            self.storage_pool = None
+            self.volume_group = volume_group
+            self.has_other_version = False
+            # facts gathered by the platform helper, see hostfacts
+            self.facts = None
+            self.platform_helper = self.get_platform_helper()
+
+            self.helper_dir = None
+            self.install_helpers()
+
+            if command_agent:
+                self.start_command_agent()
+
+            self.read_drbd_version()
+
+            if self.drbd_version_tuple < (9, 0, 0):
+                hostname_cmd = ['hostname']
+            else:
+                hostname_cmd = ['hostname', '-f']
+            if self.facts:
+                self.hostname = self.facts['hostname' if len(hostname_cmd) == 1 else 'hostname_fqdn']
+            else:
+                self.hostname = self.run(hostname_cmd, return_stdout=True)
+
+            self.netdevs = {}
+            # Network device by peer address, see cache_routes
+            self.route_cache = {}
 
-        self.netdevs = {}
+            # Platform specific initialization
+            self.platform_helper.init_host(self, storage_backend, backing_device, multi_paths, netns)
 
-        # Platform specific initialization
-        self.platform_helper.init_host(self, storage_backend, backing_device, multi_paths, netns)
+            log("host {} is running '{}' version '{}'".format(name, self.os_id, self.os_version_id))
 
-        log("host {} is running '{}' version '{}'".format(name, self.os_id, self.os_version_id))
+            self.start_dmesg()
 
-        self.start_dmesg()
+            self.run(['mkdir', '-p', self.drbd_config_dir])
+            global_config = 'global { usage-count no; }\n' + 'include "{}/{}*";\n'.format(
+                    self.drbd_config_dir, cluster.job)
+            self.run(['bash', '-c', "cat > " + self.drbd_global_config_file_path()],
+                    stdin=StringIO(global_config))
+        except BaseException:
+            try:
+                self._abort_init()
+            except Exception as e:
+                log('{}: cleaning up after the failed setup failed: {!r}'.format(name, e))
+            raise
 
-        self.run(['mkdir', '-p', self.drbd_config_dir])
-        global_config = 'global { usage-count no; }\n' + 'include "{}/{}*";\n'.format(
-                self.drbd_config_dir, cluster.job)
-        self.run(['bash', '-c', "cat > " + self.drbd_global_config_file_path()],
-                stdin=StringIO(global_config))
+    def _abort_init(self):
+        """ Stop the local processes of a host which failed to come up. """
+        if self.dmesg_process:
+            try:
+                self.platform_helper.stop_dmesg(self)
+            except Exception as e:
+                log('{}: stopping dmesg failed: {!r}'.format(self.name, e))
+            self.dmesg_process.terminate()
+            self.dmesg_process.wait()
+            self.dmesg_process = None
+        if self.dmesg_thread:
+            self.dmesg_thread.join(10)
+            self.dmesg_thread = None
+        if self.dmesg_out_file:
+            self.dmesg_out_file.close()
+            self.dmesg_out_file = None
+        if self.command_agent:
+            self.command_agent.close()
+            self.command_agent = None
+        log('{}: Closing connection to {}'.format(self.name, self.ssh.host))
+        self.ssh.close()
 
     def get_platform_helper(self):
         stdout = StringIO()
@@ -1471,6 +2040,19 @@ class Host():
             return WindowsPlatformHelper()
         raise RuntimeError("Unsupported platform: "+uname)
 
+    def start_command_agent(self):
+        """
+        Start a long-lived agent which runs the commands of this host over a
+        single SSH session. Commands fall back to plain SSH sessions when the
+        agent is not available.
+        """
+        try:
+            target_path = self.helper_path('command-agent')
+            self.command_agent = CommandAgent(self.ssh, target_path)
+        except Exception as e:
+            log('{}: command agent not available, using plain SSH: {!r}'.format(self.name, e))
+            self.command_agent = None
+
     def is_linux_host(self):
         return self.platform_helper.__class__ == LinuxPlatformHelper
 
@@ -1499,6 +2081,7 @@ class Host():
 
         Some older distributions drop this information while moving between namespaces.
         """
+        self.route_cache.clear()
         for devname, address_info in self.netdevs.items():
             base = ['ip']
             if netns:
@@ -1531,17 +2114,13 @@ class Host():
 
         self.stop_dmesg()
 
-        if self.cluster.selinux_debug:
-            audit_log = self.run(['cat', '/var/log/audit/audit.log'],
-                return_stdout=True, catch=True)
-            if audit_log:
-                out_path = os.path.join(self.cluster.logdir, 'audit-{}.log'.format(self.name))
-                with open(out_path, 'w', encoding='utf-8') as f:
-                    f.write(audit_log)
-
         self.platform_helper.cleanup_framework(self)
 
-        if hasattr(self, 'events'):
+        if self.command_agent:
+            self.command_agent.close()
+            self.command_agent = None
+
+        if self.events is not None:
             self.events.terminate()
 
         if self.events_file:
@@ -1551,13 +2130,14 @@ class Host():
         self.ssh.close()
 
     def start_dmesg_with_cmd(self, cmd):
-        self.dmesg_out_stream = io.StringIO()
+        self.dmesg_validator = dmesgvalidator.DmesgValidator(
+                on_fatal=functools.partial(self.cluster.kernel_fatal, self))
 
         out_path = os.path.join(self.cluster.logdir, 'dmesg-{}'.format(self.name))
-        self.dmesg_out_file = open(out_path, 'w', encoding='utf-8')
+        self.dmesg_out_file = logfiles.open_log_writer(out_path)
 
         self.dmesg_out_tee = drbdtestlogger.Tee()
-        self.dmesg_out_tee.add(self.dmesg_out_stream)
+        self.dmesg_out_tee.add(self.dmesg_validator)
         self.dmesg_out_tee.add(self.dmesg_out_file)
 
         condition = threading.Condition()
@@ -1595,15 +2175,15 @@ class Host():
 
         ok = True
         if validate_dmesg:
-            self.dmesg_out_stream.seek(0)
-            text = self.dmesg_out_stream.read()
-
-            pattern = re.compile(r'(BUG:|INFO:|ASSERTION|general protection fault)')
-
-            for line in text.split('\n'):
-                if pattern.search(line):
-                    log('Unexpected log line on %s: %s' % (self.name, line))
-                    ok = False
+            validator = self.dmesg_validator
+            validator.close()
+            for finding in validator.findings:
+                log('Unexpected log line on %s: %s' % (self.name, finding.line))
+                for line in finding.context():
+                    log('    ' + line)
+            if validator.matches > len(validator.findings):
+                log('%d more unexpected log lines on %s' % (validator.matches - len(validator.findings), self.name))
+            ok = validator.ok
 
         return ok
 
@@ -1632,15 +2212,45 @@ class Host():
                 'cat > {0} && chmod +x {0}'.format(target_path)],
                 stdin=StringIO(helper))
 
-    def run_helper(self, helper_name, args=[], timeout=None, return_stdout=False):
-        """ Run a target helper script. """
+    def install_helpers(self):
+        """
+        Install all target helper scripts to this node as a single archive.
+        Nothing is uploaded when the node already has the current helpers.
+        """
+        digest, archive = targethelpers.helper_archive()
+        helper_dir = targethelpers.remote_dir(digest)
+        marker = '{}/{}'.format(helper_dir, targethelpers.complete_marker)
+        try:
+            present = self.run(['bash', '-c', 'test -e {} && echo present || true'.format(marker)],
+                    return_stdout=True)
+            if present != 'present':
+                self.run(['bash', '-c',
+                    'rm -rf {0} && mkdir -p {0} && base64 -d | tar xzf - -C {0} && touch {1}'.format(
+                        helper_dir, marker)],
+                    stdin=StringIO(archive))
+        except CalledProcessError as e:
+            log('{}: could not install helper archive, installing helpers individually: {}'.format(
+                self.name, e))
+            return
+        self.helper_dir = helper_dir
+
+    def helper_path(self, helper_name):
+        """ Return the path of an installed target helper script. """
+        if self.helper_dir:
+            return '{}/{}'.format(self.helper_dir, helper_name)
         target_path = '/tmp/' + helper_name
         self.install_helper(helper_name, target_path)
+        return target_path
+
+    def run_helper(self, helper_name, args=[], timeout=None, return_stdout=False):
+        """ Run a target helper script. """
+        target_path = self.helper_path(helper_name)
         return self.run([target_path, *args], timeout=timeout, return_stdout=return_stdout)
 
     def install_drbd(self, version):
         self.rmmod()
         self.run_helper('install-drbd', [package_download_dir, version], timeout=90)
+        self.platform_helper.invalidate_drbd_facts(self)
         self.read_drbd_version()
         for resource in self.cluster.resources:
             resource.touch_config()
@@ -1654,6 +2264,12 @@ class Host():
         self.port += 1
         return port
 
+    def next_fio_count(self):
+        with self.fio_count_lock:
+            fio_count = self.fio_count
+            self.fio_count += 1
+            return fio_count
+
     def create_storage_pool(self, thin=False, discard_granularity=None):
         if self.storage_pool:
             raise RuntimeError('storage pool already created')
@@ -1673,18 +2289,29 @@ class Host():
     def listen_to_events(self):
         if self.events_file:
             self.events_file.close()
-        self.events_file = open(os.path.join(self.cluster.logdir, 'events-' + self.name), 'a')
+        self.events_file = logfiles.open_log_writer(os.path.join(self.cluster.logdir, 'events-' + self.name), 'a')
 
         try:
-            if self.events:
+            if self.events is not None:
                 self.events.terminate()
                 self.events.wait()
         except:
             pass
-        self.events = self.ssh.Popen('drbdsetup events2 all --statistics --timestamps')
-        return InputStream(self.events.stdout, tee_out=self.events_file)
-
-    def run(self, cmd, quote=True, catch=False, return_stdout=False, stdin=None, stdout=None, stderr=None, env={}, timeout=None, ignore_netns=False):
+        cmd = 'drbdsetup events2 all --statistics --timestamps'
+        interval = self.cluster.events_stats_interval
+        if interval is not None:
+            # Thin out the statistics on the target; the full stream is
+            # kept there and collected as an artifact
+            full_path = '/tmp/drbd-test-events-{}'.format(self.cluster.job)
+            cmd += ' | {} {}{} {}'.format(self.helper_path('events-filter'),
+                    '--append ' if self.events is not None else '', interval, full_path)
+            self.cluster.artifacts.add_file(self, full_path, 'events-full-' + self.name)
+        self.events = self.ssh.Popen(cmd)
+        return eventdemux.DemuxInputStream(self.events.stdout,
+                tee_out=events.EventStoreWriter(self.cluster.event_store, self.name, self.events_file))
+
+    def run(self, cmd, quote=True, catch=False, return_stdout=False, stdin=None, stdout=None, stderr=None, env={}, timeout=None, ignore_netns=False,
+            stdout_sink=None, return_bytes=False):
         """
         Run a command via SSH on the target node.
 
@@ -1698,9 +2325,16 @@ class Host():
         :param env: a dictionary of extra environment variables which will be exported to the command
         :param timeout: command timeout in seconds
         :param ignore_netns: optionally, ignore a node's configured network namespace
-        :returns: nothing, or a string if return_stdout is True
+        :param stdout_sink: a local file path or a callable which receives the
+            raw bytes of the standard output as they arrive, without decoding
+        :param return_bytes: return the raw standard output as bytes
+        :returns: nothing, a string if return_stdout is True, or bytes if
+            return_bytes is True
         :raise CalledProcessError: when the command fails (unless catch is True)
         """
+        if sum([return_stdout, return_bytes, stdout_sink is not None]) > 1:
+            raise RuntimeError('return_stdout, return_bytes and stdout_sink are mutually exclusive')
+
         stdout = stdout or drbdtestlogger.logstream
         stderr = stderr or drbdtestlogger.logstream
         stdin = stdin or False # False means no stdin
@@ -1708,16 +2342,22 @@ class Host():
             # if stdout should be returned, do not log stdout to logstream too
             stdout = StringIO()
 
-        if quote:
-            cmd_string = ' '.join(shlex.quote(str(x)) for x in cmd)
-        else:
-            cmd_string = ' '.join(cmd)
-
-        if not ignore_netns and self.netns:
-            cmd_string = "ip netns exec {} {}".format(self.netns, cmd_string)
+        cmd_string = self.cmd_string(cmd, quote=quote, ignore_netns=ignore_netns)
 
         log(self.name + ': ' + cmd_string)
-        result = self.ssh.run(cmd_string, env=env, stdin=stdin, stdout=stdout, stderr=stderr, timeout=timeout)
+        chunks = []
+        if return_bytes:
+            result = self.execute_binary(cmd_string, chunks.append,
+                    env=env, stdin=stdin, stderr=stderr, timeout=timeout)
+        elif isinstance(stdout_sink, str):
+            with open(stdout_sink, 'wb') as sink_file:
+                result = self.execute_binary(cmd_string, sink_file.write,
+                        env=env, stdin=stdin, stderr=stderr, timeout=timeout)
+        elif stdout_sink is not None:
+            result = self.execute_binary(cmd_string, stdout_sink,
+                    env=env, stdin=stdin, stderr=stderr, timeout=timeout)
+        else:
+            result = self.execute(cmd_string, env=env, stdin=stdin, stdout=stdout, stderr=stderr, timeout=timeout)
         if result != 0:
             if catch:
                 print('error: {} failed ({})'.format(cmd[0], result), file=drbdtestlogger.logstream)
@@ -1726,6 +2366,149 @@ class Host():
 
         if return_stdout:
             return stdout.getvalue().strip()
+        if return_bytes:
+            return b''.join(chunks)
+
+    async def arun(self, cmd, quote=True, catch=False, return_stdout=False, stdin=None, env={}, timeout=None, ignore_netns=False):
+        """
+        Coroutine variant of run(). The command runs in its own session over
+        the SSH control master connection, so that several commands can be
+        awaited concurrently in one event loop. The output of the command is
+        logged once it has finished.
+
+        See the "run" method for documentation of the arguments.
+        """
+        cmd_string = self.cmd_string(cmd, quote=quote, ignore_netns=ignore_netns)
+        if env:
+            cmd_string = SSH.inline_env(cmd_string, env)
+        if timeout is None:
+            timeout = self.ssh.timeout
+
+        log(self.name + ': ' + cmd_string)
+        p = await asyncio.create_subprocess_exec('ssh', '-S', self.ssh.sockpath, '_', cmd_string,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        input_data = stdin.read().encode('utf-8') if stdin else None
+        try:
+            with self.cluster.interrupt.track(p.kill):
+                out, err = await asyncio.wait_for(p.communicate(input_data), timeout)
+        except asyncio.TimeoutError:
+            p.kill()
+            await p.wait()
+            raise TimeoutException()
+
+        stdout = out.decode('utf-8', errors='backslashreplace')
+        if not return_stdout:
+            drbdtestlogger.logstream.write(stdout)
+        drbdtestlogger.logstream.write(err.decode('utf-8', errors='backslashreplace'))
+
+        if p.returncode != 0:
+            if catch:
+                print('error: {} failed ({})'.format(cmd[0], p.returncode), file=drbdtestlogger.logstream)
+            else:
+                raise CalledProcessError(p.returncode, cmd_string)
+
+        if return_stdout:
+            return stdout.strip()
+
+    def cmd_string(self, cmd, quote=True, ignore_netns=False):
+        """
+        Build the remote command string for a command given as a list of
+        strings. See the "run" method for documentation of the arguments.
+        """
+        if quote:
+            cmd_string = ' '.join(shlex.quote(str(x)) for x in cmd)
+        else:
+            cmd_string = ' '.join(cmd)
+
+        if not ignore_netns and self.netns:
+            cmd_string = "ip netns exec {} {}".format(self.netns, cmd_string)
+
+        return cmd_string
+
+    def execute(self, cmd_string, env={}, stdin=False, stdout=None, stderr=None, timeout=None):
+        """
+        Execute a remote command string without logging it and return its
+        exit code. Uses the command agent when it is available.
+        """
+        if timeout is None:
+            timeout = self.ssh.timeout
+
+        # stdin None means "inherit the controller's stdin", which only plain
+        # SSH can do
+        if self.command_agent and stdin is not None:
+            try:
+                with self.cluster.interrupt.track(self.command_agent.interrupt):
+                    return self.command_agent.run(SSH.inline_env(cmd_string, env) if env else cmd_string,
+                            stdin=stdin, stdout=stdout, stderr=stderr, timeout=timeout)
+            except CommandAgentBusy:
+                # Run concurrent commands over their own SSH sessions
+                pass
+            except CommandAgentUnavailable:
+                log('{}: command agent terminated, falling back to plain SSH'.format(self.name))
+                self.command_agent = None
+
+        # Like SSH.run, but the process can be killed by the fatal kernel
+        # message interrupt
+        p = self.ssh.Popen(cmd_string, env)
+        with self.cluster.interrupt.track(p.kill):
+            self.ssh.pipeIO(p, stdin, stdout, stderr, timeout=timeout)
+            return p.wait()
+
+    def execute_binary(self, cmd_string, sink, env={}, stdin=False, stderr=None, timeout=None):
+        """
+        Execute a remote command string without logging it and return its
+        exit code. The standard output is passed to sink as raw bytes while
+        it arrives. Always uses plain SSH, since the command agent buffers
+        the whole output.
+        """
+        if timeout is None:
+            timeout = self.ssh.timeout
+        stderr = stderr or drbdtestlogger.logstream
+
+        p = self.ssh.Popen(cmd_string, env)
+        with self.cluster.interrupt.track(p.kill):
+            if stdin:
+                p.stdin.write(stdin.read().encode('utf-8'))
+            p.stdin.close()
+
+            stderr_splitter = IncrementalLineSplitter()
+            read_list = [p.stdout, p.stderr]
+            start_time = time.time()
+            while read_list:
+                if timeout and time.time() - start_time >= timeout:
+                    p.kill()
+                    p.wait()
+                    raise TimeoutException()
+
+                for stream in select.select(read_list, [], [], 1)[0]:
+                    # the streams are non-blocking, so this reads the available bytes
+                    data = stream.read()
+                    if data is None:
+                        continue
+                    if not data:
+                        read_list.remove(stream)
+                    elif stream is p.stdout:
+                        sink(data)
+                    else:
+                        for line in stderr_splitter.split(data):
+                            stderr.write(line.decode('utf-8', errors='backslashreplace') + '\n')
+
+            stderr.write(stderr_splitter.read_remaining().decode('utf-8', errors='backslashreplace'))
+            return p.wait()
+
+    def batch(self, timeout=None):
+        """
+        Queue commands and run them in one round trip when the returned
+        context manager exits. Example:
+
+        with host.batch() as batch:
+            batch.run(['udevadm', 'trigger'])
+            settle = batch.run(['udevadm', 'settle'], catch=True)
+        log(settle.returncode)
+
+        :param timeout: timeout in seconds for the whole batch
+        """
+        return Batch(self, timeout=timeout)
 
     def run_quiet(self, cmd, quote=True, stdin=None, env={}, timeout=None, ignore_netns=False):
         """
@@ -1754,6 +2537,19 @@ class Host():
         Expects that the caller made the resource already primary on
         platforms that do not support auto promote (Windows)
         """
+        cmd = self._fio_cmd(filename, base_args, kwargs)
+        fio_count = self.next_fio_count()
+        result = self.run(cmd, return_stdout=True)
+        return self._fio_result(fio_count, result)
+
+    async def afio_file(self, filename, base_args={}, **kwargs):
+        """ Coroutine variant of fio_file(). """
+        cmd = self._fio_cmd(filename, base_args, kwargs)
+        fio_count = self.next_fio_count()
+        result = await self.arun(cmd, return_stdout=True)
+        return self._fio_result(fio_count, result)
+
+    def _fio_cmd(self, filename, base_args, kwargs):
         native_filename = self.native_filename(filename)
 
         # All colons have special meaning for fio: file name
@@ -1773,11 +2569,13 @@ class Host():
         if self.is_windows_host():
             cmd += ['--thread']	        # silences a fio warning
 
-        result = self.run(cmd, return_stdout=True)
+        return cmd
 
-        output_filename = 'fio-{}-{}.json'.format(self.name, self.fio_count)
+    def _fio_result(self, fio_count, result):
+        """ Save the fio output and return it parsed. """
+        output_filename = 'fio-{}-{}.json'.format(self.name, fio_count)
         log('write fio output to {}'.format(output_filename))
-        with open(os.path.join(self.cluster.logdir, output_filename), 'w') as output_file:
+        with logfiles.open_log_writer(os.path.join(self.cluster.logdir, output_filename)) as output_file:
             output_file.write(result)
 
         fio_output = json.loads(result)
@@ -1788,16 +2586,37 @@ class Host():
             job['write']['io_kbytes'],
             job['elapsed']))
 
-        self.fio_count = self.fio_count + 1
         return fio_output
 
+    def cache_routes(self, addrs):
+        """
+        Look up the network devices via which the given addresses are
+        reachable in a single batch. The results are kept until the network
+        devices are moved by ensure_netdev.
+        """
+        addrs = [addr for addr in dict.fromkeys(addrs) if addr not in self.route_cache]
+        if not addrs:
+            return
+
+        with self.batch() as batch:
+            # 'ip -j' is not supported by older iproute2
+            lookups = [(addr, batch.run(['bash', '-c',
+                    'ip -j route get {0} 2> /dev/null || ip -o route get {0}'.format(shlex.quote(addr))],
+                    return_stdout=True))
+                for addr in addrs]
+
+        for addr, lookup in lookups:
+            if lookup.stdout.startswith('['):
+                dev = json.loads(lookup.stdout)[0]['dev']
+            else:
+                dev = lookup.stdout.split(' ')[2]
+            self.route_cache[addr] = dev
+
     def net_device_to_peer(self, peer_host, net_num=0):
         """Returns the network device this peer is reachable via."""
-        lines = self.run(['ip', '-o', 'route', 'get', peer_host.addrs[net_num]],
-                         return_stdout=True)
-        fields = lines.split(' ')
-        dev = fields[2]
-        return dev
+        addr = peer_host.addrs[net_num]
+        self.cache_routes([addr])
+        return self.route_cache[addr]
 
 
 class Node():
@@ -1837,6 +2656,20 @@ class Node():
     def __repr__(self):
         return '{}:{}'.format(self.resource, self.name)
 
+    def event_query(self):
+        """ Return the EventStore query arguments for this node's resource events. """
+        return dict(host=self.host.name, obj='resource', resource=self.resource.name,
+                peer_node_id=None, volume=None)
+
+    @property
+    def state(self):
+        """ The current state of the resource on this node, for example node.state.role """
+        return self.resource.cluster_state(**self.event_query())
+
+    def statistics(self):
+        """ The events2 statistics of the resource on this node as an eventstats.TimeSeries """
+        return self.resource.statistics_series(**self.event_query())
+
     def add_disk(self, volume_number, size=None, *, meta_size=None, max_size=None, delay_ms=None, logical_block_size=None, zero_out=False):
         """
         Create the block device for a volume on this node. Does not initialise
@@ -2021,15 +2854,27 @@ class Node():
         """ Create or update the configuration file on the node when needed. """
 
         if self.config_changed:
-            self.config_changed = False
-            config = self.config()
-            file = open(os.path.join(self.resource.cluster.logdir,
-                                     'drbd.conf-{}-{}'.format(self.resource.name.replace('/', '_'), self.name)), 'w')
-            file.write(config)
-            file.close
+            config = self._save_config()
             self.run(['bash', '-c', 'cat > ' + self.drbd_config_file_path()],
                     stdin=StringIO(config), update_config=False)
 
+    async def aupdate_config(self):
+        """ Coroutine variant of update_config(). """
+
+        if self.config_changed:
+            config = self._save_config()
+            await self.arun(['bash', '-c', 'cat > ' + self.drbd_config_file_path()],
+                    stdin=StringIO(config), update_config=False)
+
+    def _save_config(self):
+        """ Generate the configuration and keep a copy in the log directory. """
+        self.config_changed = False
+        config = self.config()
+        with logfiles.open_log_writer(os.path.join(self.resource.cluster.logdir,
+                'drbd.conf-{}-{}'.format(self.resource.name.replace('/', '_'), self.name))) as file:
+            file.write(config)
+        return config
+
     def config_proxy(self):
         """ Update DRBD proxy options in the configuration file. """
         # TODO: (wap) Implement adding proxy options
@@ -2046,11 +2891,46 @@ class Node():
 
         return self.host.run(*args, **kwargs)
 
+    async def arun(self, *args, update_config=True, **kwargs):
+        """
+        Coroutine variant of run(). Arguments are passed to Host.arun.
+
+        :param update_config: whether or not to update the DRBD config file before running
+        """
+        if update_config:
+            await self.aupdate_config()
+
+        return await self.host.arun(*args, **kwargs)
+
+    def batch(self, update_config=True, **kwargs):
+        """
+        Queue commands to run on the target node in one round trip. Arguments
+        are passed to Host.batch.
+
+        :param update_config: whether or not to update the DRBD config file before running
+        """
+        if update_config:
+            self.update_config()
+
+        return self.host.batch(**kwargs)
+
     def fio_file(self, *args, **kwargs):
         self.host.fio_file(*args, **kwargs)
 
+    async def afio_file(self, *args, **kwargs):
+        return await self.host.afio_file(*args, **kwargs)
+
     def drbdadm(self, cmd, **kwargs):
-        self.run(['drbdadm', '-c', self.host.drbd_global_config_file_path(), '-v'] + cmd, **kwargs)
+        self.resource.cluster.latency.command_issued(self.host, self.resource.name, cmd)
+        self.run(self._drbdadm_cmd(cmd), **kwargs)
+
+    async def adrbdadm(self, cmd, **kwargs):
+        """ Coroutine variant of drbdadm(). """
+        self.resource.cluster.latency.command_issued(self.host, self.resource.name, cmd)
+        await self.arun(self._drbdadm_cmd(cmd), **kwargs)
+
+    def _drbdadm_cmd(self, cmd):
+        return ['drbdadm', '-c', self.host.drbd_global_config_file_path(), '-v'] + cmd
 
     # dump the drbd metadata to a file on the target node
     def dump_md_to_file(self, filename):
@@ -2118,6 +2998,12 @@ class Node():
     def event(self, *args, **kwargs):
         return Nodes([self]).event(*args, **kwargs)
 
+    async def aevent(self, *args, **kwargs):
+        return await Nodes([self]).aevent(*args, **kwargs)
+
+    def expect(self, *args, **kwargs):
+        return Nodes([self]).expect(*args, **kwargs)
+
     def asPrimary(self, **kwargs):
         return AsPrimary(self, **kwargs)
 
@@ -2332,7 +3218,7 @@ class Node():
         out = self.run(
             ['drbdmeta', '--force', '-', 'v09', vol.disk, 'internal',
              'dump-superblock', '--output-format', 'json'],
-            return_stdout=True)
+            return_bytes=True)
         return json.loads(out)
 
     @staticmethod
@@ -2382,7 +3268,7 @@ def setup_resource(*args, **kwargs):
     return cluster.create_resource()
 
 
-def setup(nodes=None, max_nodes=None, min_nodes=2, multi_paths=False, netns=None):
+def setup(nodes=None, max_nodes=None, min_nodes=2, multi_paths=False, netns=None, event_store=False):
     """
     Test setup.  Returns a cluster object.
 
@@ -2392,6 +3278,9 @@ def setup(nodes=None, max_nodes=None, min_nodes=2, multi_paths=False, netns=None
       multi_paths
                 -- set up addresses for multi-path testing
       netns     -- set up network namespaces
+      event_store
+                -- parse the events into the event store, for expect(),
+                   find_events(), the object states and the statistics
     """
     parser=argparse.ArgumentParser()
     parser.add_argument('host', nargs='*')
@@ -2421,6 +3310,16 @@ def setup(nodes=None, max_nodes=None, min_nodes=2, multi_paths=False, netns=None
     parser.add_argument('--drbd-other-node', type=int, default=0, help='index of node to install "other" version on')
     parser.add_argument('--ssh-config', type=str, help='Use this ssh-config to connect to test nodes')
     parser.add_argument('--selinux-debug', action='store_true', help='Disable SELinux dontaudit rules to make all denials visible')
+    parser.add_argument('--command-agent', action='store_true', help='Run commands through a persistent agent on each test node')
+    parser.add_argument('--async-log', action='store_true',
+            help='Write the test log from a background thread instead of flushing it for every line')
+    parser.add_argument('--log-compression', default='none', choices=('none', 'gzip', 'zstd'),
+            help='Compress the logs in the log directory while they are written')
+    parser.add_argument('--event-store', action='store_true',
+            help='Parse the events into the event store even if the test does not require it')
+    parser.add_argument('--events-stats-interval', type=float,
+            help='Forward statistics-only events at most every this many seconds per object (0: drop them); '
+                 'the full events are collected as events-full-<host>')
     args = parser.parse_args()
 
     if nodes is not None:
@@ -2474,7 +3373,15 @@ def setup(nodes=None, max_nodes=None, min_nodes=2, multi_paths=False, netns=None
                 raise e
         os.symlink(args.job, os.path.join('log', job_symlink))
 
-    drbdtestlogger.open_logstream(os.path.join(args.logdir, 'test.log'))
+    try:
+        logfiles.set_compression(args.log_compression)
+    except RuntimeError as e:
+        parser.error(str(e))
+    drbdtestlogger.open_logstream(os.path.join(args.logdir, 'test.log'),
+            os.path.join(args.logdir, 'test-timestamps.log'), async_writer=args.async_log)
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        if signal.getsignal(signum) == signal.SIG_DFL:
+            signal.signal(signum, flush_logs_on_signal)
 
     global proxy_enable
     proxy_enable = args.proxy
@@ -2539,20 +3446,36 @@ def setup(nodes=None, max_nodes=None, min_nodes=2, multi_paths=False, netns=None
             drbd_version_other=args.drbd_version_other,
             resource_name=args.resource,
             transport=args.transport,
-            tls=args.tls)
+            tls=args.tls,
+            event_store=event_store or args.event_store)
 
-    for i, host_name in enumerate(args.host):
+    started_hosts = {}
+
+    def init_host(i, host_name):
         host = Host(cluster, host_name,
             args.volume_group, args.storage_backend, args.backing_device,
-            multi_paths=multi_paths, netns=netns, ssh_config=args.ssh_config)
-
-        cluster.hosts.append(host)
+            multi_paths=multi_paths, netns=netns, ssh_config=args.ssh_config,
+            command_agent=args.command_agent)
+        started_hosts[i] = host
 
         if args.drbd_version_other and i == args.drbd_other_node:
             # Automatically install other version
             host.install_drbd(args.drbd_version_other)
             host.has_other_version = True
 
+        return host
+
+    # Bring up the hosts concurrently. The order of cluster.hosts is the
+    # order of the command line arguments.
+    try:
+        cluster.hosts = parallel.run_parallel(
+                [(host_name, functools.partial(init_host, i, host_name))
+                    for i, host_name in enumerate(args.host)])
+    except Exception:
+        # Clean up the hosts which did come up
+        cluster.hosts = [started_hosts[i] for i in sorted(started_hosts)]
+        raise
+
     if args.tls == 'yes':
         tls.setup_kernel_tls_helper(cluster.hosts)
 
@@ -2562,23 +3485,29 @@ def setup(nodes=None, max_nodes=None, min_nodes=2, multi_paths=False, netns=None
     with open(drbd_versions_meta_path, 'w') as f:
         cluster.write_drbd_versions_meta(f)
 
+    cluster.events_stats_interval = args.events_stats_interval
     cluster.listen_to_events()
+    cluster.measure_clock_offsets()
+
+    if args.selinux_debug:
+        cluster.selinux_debug = True
 
-    for host in cluster.hosts:
+    def prepare_host(host):
         host.disable_faults()
 
-    # When SELinux is active, verify that the drbd-selinux policy module is
-    # compatible with this system. Raises on policydb version mismatch.
-    for host in cluster.hosts:
+        # When SELinux is active, verify that the drbd-selinux policy module is
+        # compatible with this system. Raises on policydb version mismatch.
         getenforce = host.run(['getenforce'], return_stdout=True, catch=True).strip()
         if getenforce in ('Enforcing', 'Permissive'):
             host.run_helper('check-selinux-policydb')
 
-    if args.selinux_debug:
-        cluster.selinux_debug = True
-        for host in cluster.hosts:
+        if args.selinux_debug:
             log('{}: disabling SELinux dontaudit rules'.format(host.hostname))
             host.run(['semodule', '-DB'])
+            cluster.artifacts.add_file(host, '/var/log/audit/audit.log',
+                    'audit-{}.log'.format(host.name), keep_empty=False)
+
+    parallel.run_parallel([(host, functools.partial(prepare_host, host)) for host in cluster.hosts])
 
     return cluster
 
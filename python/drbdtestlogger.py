@@ -1,4 +1,12 @@
+import atexit
+import contextlib
+import datetime
+import queue
 import sys
+import threading
+import time
+
+from . import logfiles
 
 # stream to write output to
 logstream = None
@@ -12,6 +20,7 @@ class Tee(object):
 
     def __init__(self):
         self.streams = set()
+        self._local = threading.local()
 
     def add(self, stream):
         # Do not modify self.streams in place. Another thread may be iterating over it.
@@ -25,21 +34,211 @@ class Tee(object):
         streams.remove(stream)
         self.streams = streams
 
+    @contextlib.contextmanager
+    def capture(self):
+        """
+        Collect the writes made by the current thread in a list instead of
+        replicating them. Writes from other threads are not affected.
+        """
+        previous = getattr(self._local, 'captured', None)
+        captured = []
+        self._local.captured = captured
+        try:
+            yield captured
+        finally:
+            self._local.captured = previous
+
     def write(self, message):
+        captured = getattr(self._local, 'captured', None)
+        if captured is not None:
+            captured.append(message)
+            return
+
         for stream in self.streams:
             stream.write(message)
 
     def flush(self):
+        if getattr(self._local, 'captured', None) is not None:
+            return
+
         for stream in self.streams:
             stream.flush()
 
-def open_logstream(fname):
-    logfile = open(fname, 'w', encoding='utf-8')
-    # no need to close logfile - it is kept open until the program terminates
+    def sync(self):
+        """ Make sure that everything written so far has reached the streams. """
+        self.flush()
+
+class AsyncTee(Tee):
+    """
+    Tee which hands the writes to a background thread, so that logging does
+    not wait for the streams. The thread flushes the streams once flush_bytes
+    have been written or flush_interval seconds have passed, instead of on
+    every flush() call. At most max_queued writes are queued; further writes
+    wait for the thread, but no longer than wait_timeout seconds. If the
+    thread is gone or stuck, writes go to the streams directly.
+
+    TimestampWriter streams are stamped when the message is written, in the
+    writing thread, rather than when the writer thread gets to it.
+    """
+
+    def __init__(self, max_queued=10000, flush_interval=1.0, flush_bytes=65536, wait_timeout=10):
+        super().__init__()
+        self.queue = queue.Queue(max_queued)
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.wait_timeout = wait_timeout
+        self.closed = False
+        # Streams which failed in the writer thread, reported once each
+        self.failed = set()
+        self.thread = threading.Thread(target=self._writer, name='log writer', daemon=True)
+        self.thread.start()
+
+    def write(self, message):
+        captured = getattr(self._local, 'captured', None)
+        if captured is not None:
+            captured.append(message)
+            return
+
+        stamped = {stream: stream.stamp(message)
+                for stream in self.streams if isinstance(stream, TimestampWriter)}
+        item = (message, stamped)
+        if not self._put(item):
+            # Late messages at exit, or the writer thread is not available
+            for stream in self.streams:
+                self._write_item(stream, item)
+
+    def flush(self):
+        # The writer thread flushes
+        pass
+
+    def sync(self):
+        """ Wait until everything written so far has been written and flushed. """
+        done = threading.Event()
+        if not self._put(done) or not done.wait(self.wait_timeout):
+            super().flush()
+
+    def close(self):
+        """ Write and flush the queued messages and stop the thread. """
+        if self.closed:
+            return
+        if self._put(None):
+            self.thread.join(self.wait_timeout)
+        self.closed = True
+
+    def _put(self, item):
+        """ Queue item for the writer thread. Returns False if it cannot take it. """
+        if self.closed or not self.thread.is_alive():
+            return False
+        try:
+            self.queue.put(item, timeout=self.wait_timeout)
+        except queue.Full:
+            return False
+        return True
+
+    @staticmethod
+    def _write_item(stream, item):
+        message, stamped = item
+        if stream in stamped:
+            stream.write_stamped(stamped[stream])
+        elif not isinstance(stream, TimestampWriter):
+            stream.write(message)
+        # else: added after the message was written
+
+    def _for_each_stream(self, action):
+        for stream in self.streams:
+            try:
+                action(stream)
+            except Exception as e:
+                if stream not in self.failed:
+                    self.failed.add(stream)
+                    print('log writer: writing to {} failed: {!r}'.format(stream, e), file=sys.__stderr__)
+
+    def _writer(self):
+        pending = 0
+        last_flush = time.time()
+        while True:
+            timeout = max(0, last_flush + self.flush_interval - time.time()) if pending else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if isinstance(item, tuple):
+                self._for_each_stream(lambda stream: self._write_item(stream, item))
+                pending += len(item[0])
+                if pending < self.flush_bytes and time.time() - last_flush < self.flush_interval:
+                    continue
+
+            self._for_each_stream(lambda stream: stream.flush())
+            pending = 0
+            last_flush = time.time()
+
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+
+class TimestampWriter(object):
+    """
+    Writes each complete line to stream, prefixed with the current time as an
+    ISO 8601 timestamp, in the format of the events2 timestamps.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        # Lines are written piecewise, possibly by several threads
+        self._local = threading.local()
+
+    def stamp(self, message):
+        """
+        Return the lines which message completes for the current thread,
+        prefixed with the current time.
+        """
+        partial = getattr(self._local, 'partial', '') + message
+        lines = partial.split('\n')
+        self._local.partial = lines.pop()
+        if not lines:
+            return ''
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        return ''.join('{} {}\n'.format(now, line) for line in lines)
+
+    def write_stamped(self, text):
+        """ Write lines returned by stamp(). """
+        if text:
+            self.stream.write(text)
+
+    def write(self, message):
+        self.write_stamped(self.stamp(message))
+
+    def flush(self):
+        self.stream.flush()
+
+def open_logstream(fname, timestamps_fname=None, async_writer=False):
+    """
+    Log to stderr and fname. If timestamps_fname is given, the lines are
+    also written there with the time at which they were logged. With
+    async_writer, the streams are written by a background thread, see
+    AsyncTee.
+    """
     global logstream
-    logstream = Tee()
+    logstream = AsyncTee() if async_writer else Tee()
+    files = [logfiles.open_log_writer(fname)]
     logstream.add(sys.stderr)
-    logstream.add(logfile)
+    logstream.add(files[0])
+    if timestamps_fname:
+        files.append(logfiles.open_log_writer(timestamps_fname))
+        logstream.add(TimestampWriter(files[-1]))
+
+    def close():
+        # The files are kept open until the program terminates; compressed
+        # logs need to be closed to be complete. Drain the writer thread
+        # first so that no queued lines are lost.
+        if async_writer:
+            logstream.close()
+        for f in files:
+            f.close()
+
+    atexit.register(close)
 
 def log(*args, **kwargs):
     """ Print message to stderr """
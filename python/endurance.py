@@ -14,6 +14,12 @@ data_size = '{}M'.format(size_mb)
 # the timeout.
 test_runtime = 9 * 60
 
+# Events kept in memory. The statistics make the events2 streams grow
+# throughout the run; keep the history bounded so that long runs do not grow
+# the memory usage of the test.
+event_retention = 20000
+statistics_retention = 10000
+
 
 class EnduranceConfig(object):
     protocol: typing.Optional[str]
@@ -102,6 +108,9 @@ def run_resync(resource, config):
 
     start = time.time()
     while time.time() - start < test_runtime:
+        # The events of the previous iteration are not needed any more
+        resource.cluster.checkpoint()
+
         fio_rate = fio_rates[count % len(fio_rates)]
         # We wait up to 30s for the resync to complete. Perform IO for longer
         # than this to ensure that IO is active for the entire resync.
@@ -131,6 +140,8 @@ def run_resync(resource, config):
 
 
 def setup(resource, config, primary_n, diskful_nodes):
+    resource.cluster.set_event_retention(event_retention, statistics_retention)
+
     resource.disk_options = 'al-extents 67; c-max-rate 1G; c-min-rate 0;'
     resource.net_options = 'protocol {};'.format(config.protocol if config.protocol else 'C')
 
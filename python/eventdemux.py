@@ -0,0 +1,154 @@
+"""
+Per-resource views of the events2 streams. Each line of a host's stream is
+routed by its "name:" field into the view of that resource as it is read, so
+that the waits of a resource only scan the lines of that resource. Lines
+without a resource name, such as "exists -", go to all views. The lines keep
+their line numbers in the host's stream.
+
+Consuming lines in a view also consumes the lines up to the same position in
+the host's stream, and vice versa for the other views, so that a wait does
+not match events which an earlier wait on the same host has passed over.
+Only the lines of other resources are kept.
+"""
+
+import select
+
+from lbpytest.logscan import InputStream, TimeoutException
+
+from . import events, patterns
+
+
+class DemuxInputStream(events.BoundedInputStream):
+    """ The events2 stream of a host, with a view per resource. """
+
+    _max_lines = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Per resource name, a BoundedInputStream with the lines of that resource
+        self.views = {}
+
+    @property
+    def max_lines(self):
+        return self._max_lines
+
+    @max_lines.setter
+    def max_lines(self, value):
+        self._max_lines = value
+        for view in self.views.values():
+            view.max_lines = value
+
+    def add_view(self, name):
+        view = events.BoundedInputStream(None)
+        view.line_number = self.line_number
+        view.max_lines = self.max_lines
+        self.views[name] = view
+        return view
+
+    def append_line(self, data):
+        InputStream.append_line(self, data)
+        line = self.lines[-1]
+        self.trim()
+        self.route(line)
+
+    def route(self, line):
+        text = line.text
+        start = text.find(' name:')
+        if start < 0:
+            views = self.views.values()
+        else:
+            start += len(' name:')
+            end = text.find(' ', start)
+            name = text[start:end] if end >= 0 else text[start:]
+            view = self.views.get(name)
+            if view is None:
+                return
+            views = [view]
+            # "rename resource name:a new_name:b"; later lines use the new name
+            if ' rename ' in text:
+                new_start = text.find(' new_name:')
+                if new_start >= 0:
+                    new_start += len(' new_name:')
+                    new_end = text.find(' ', new_start)
+                    self.views[text[new_start:new_end] if new_end >= 0 else text[new_start:]] = \
+                            self.views.pop(name)
+
+        for view in views:
+            view.lines.append(line)
+            view.line_number = line.number + 1
+            view.trim()
+
+    def discard_views_through(self, number):
+        for view in self.views.values():
+            view.discard_through(number)
+
+
+class TrackingLogscan(patterns.CachingLogscan):
+    """
+    Logscan which reports up to which line it consumed an input. Waits end
+    with KernelFatalError when the given fatal.Interrupt is triggered.
+    """
+
+    def __init__(self, inputs, timeout=30, consumed=None, interrupt=None):
+        super().__init__(inputs, timeout=timeout)
+        self.consumed = consumed
+        self.interrupt = interrupt
+
+    def _read_input(self, context, remaining):
+        if not self.interrupt:
+            return super()._read_input(context, remaining)
+        self.interrupt.check()
+        ready = select.select(self.read_list + [self.interrupt], [], [], remaining)[0]
+        self.interrupt.check()
+        if not ready:
+            raise TimeoutException(self._timeout_message(context))
+        # Read the streams which are ready now
+        super()._read_input(context, 0)
+
+    def _match_input_lines(self, context, label):
+        input = self.inputs[label]
+        spill = getattr(input, 'spill', None)
+        if spill:
+            # The lines moved out of memory are older than the others
+            lines = input.lines
+            try:
+                while spill and label in context.regexes_pending:
+                    input.lines = spill.read(input.max_lines or 1000)
+                    try:
+                        self._match_tracked(context, label)
+                    finally:
+                        spill.unread(input.lines)
+            finally:
+                input.lines = lines
+            if spill:
+                return
+        self._match_tracked(context, label)
+
+    def _match_tracked(self, context, label):
+        input = self.inputs[label]
+        lines = input.lines
+        try:
+            super()._match_input_lines(context, label)
+        finally:
+            count = len(lines) - len(input.lines)
+            if count and self.consumed:
+                self.consumed(label, lines[count - 1].number)
+
+
+class ViewLogscan(TrackingLogscan):
+    """
+    Logscan over the views of one resource. The host streams are read with
+    the given read function, which routes the lines into the views.
+    """
+
+    def __init__(self, inputs, read, timeout=30, consumed=None, interrupt=None):
+        super().__init__(inputs, timeout=timeout, consumed=consumed, interrupt=interrupt)
+        self.read = read
+
+    def _read_input(self, context, remaining):
+        line_numbers = [input.line_number for input in self.inputs.values()]
+        ready = self.read(remaining)
+        # Lines of other resources may keep arriving after the timeout
+        if not ready or (remaining <= 0 and
+                line_numbers == [input.line_number for input in self.inputs.values()]):
+            raise TimeoutException(self._timeout_message(context))
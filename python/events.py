@@ -0,0 +1,552 @@
+"""
+Structured access to the "drbdsetup events2" streams of the hosts.
+
+Each line is parsed once into an EventRecord when it is read. The records are
+kept in an EventStore which is indexed by host, object type, resource, peer
+node id and volume, so that queries are lookups rather than regular
+expression scans over all lines. Example line:
+
+2024-01-01T12:00:00.000000+00:00 change peer-device name:r0 peer-node-id:1 conn-name:b volume:0 replication:Established
+
+By default all records are kept for the whole test. For long runs, the
+retention can be bounded: the store then keeps only the newest records in
+memory, and checkpoint() discards the records which no pending wait needs.
+Discarded records are not lost, the events-<host> files in the log directory
+contain every line.
+
+The store is optional, see drbdtest.setup(event_store=True), since parsing
+every line costs about as much as the regular expression matching of the
+waits. The event() waits of the collections do not use the store: they still
+scan the lines with Logscan, because their forbidden patterns have to be
+checked against every line and they consume the lines they pass over. The
+store serves the record based waits (expect, wait_all, wait_any), queries
+(find_events), the state model and the statistics.
+"""
+
+import bisect
+import datetime
+import os
+import select
+import tempfile
+import threading
+import time
+import weakref
+
+from lbpytest.logscan import InputStream, Line, NegativeMatchException, TimeoutException
+
+from . import patterns
+
+# Default for query arguments which are not restricted. None is a real value:
+# records of objects without a volume have volume None.
+ANY = object()
+
+
+class EventRecord(object):
+    """ A single parsed events2 line. """
+
+    __slots__ = ('host', 'seq', 'line', 'timestamp', 'action', 'obj', 'resource',
+            'volume', 'peer_node_id', 'fields', 'text')
+
+    def __init__(self, host, seq, line, timestamp, action, obj, fields, text):
+        self.host = host
+        self.seq = seq
+        self.line = line
+        self.timestamp = timestamp
+        self.action = action
+        self.obj = obj
+        self.fields = fields
+        self.text = text
+        self.resource = fields.get('name')
+        self.volume = _int_or_none(fields.get('volume'))
+        self.peer_node_id = _int_or_none(fields.get('peer-node-id'))
+
+    def key(self):
+        return (self.host, self.obj, self.resource, self.peer_node_id, self.volume)
+
+    def get(self, field, default=None):
+        return self.fields.get(field, default)
+
+    def __repr__(self):
+        return '{}:{}: {}'.format(self.host, self.line, self.text)
+
+
+def _int_or_none(value):
+    return int(value) if value is not None and value.isdigit() else None
+
+
+def _parse_timestamp(word):
+    try:
+        return datetime.datetime.fromisoformat(word).timestamp()
+    except ValueError:
+        return None
+
+
+def parse_event_line(host, seq, line, text):
+    """
+    Parse an events2 line. Returns None for lines which are not events, such
+    as empty lines.
+    """
+    words = text.split()
+    timestamp = _parse_timestamp(words[0]) if words else None
+    if timestamp is not None:
+        words = words[1:]
+    if len(words) < 2:
+        return None
+
+    fields = {}
+    for word in words[2:]:
+        key, sep, value = word.partition(':')
+        if sep:
+            fields[key] = value
+    return EventRecord(host, seq, line, timestamp, words[0], words[1], fields, text)
+
+
+class LineSpill(object):
+    """
+    The oldest unconsumed lines of an input, moved out of memory into a
+    temporary file. The lines are read back in the order they were written.
+    """
+
+    def __init__(self):
+        self.file = None
+        self.read_offset = 0
+        # Lines which were read back but not consumed, see unread
+        self.head = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def write(self, lines):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile()
+        self.file.seek(0, os.SEEK_END)
+        self.file.writelines('{} {}\n'.format(line.number, line.text).encode('utf-8') for line in lines)
+        self.count += len(lines)
+
+    def read(self, max_lines):
+        """ Remove and return up to max_lines of the oldest lines. """
+        lines = self.head[:max_lines]
+        del self.head[:max_lines]
+        if len(lines) < max_lines and self.file is not None:
+            self.file.seek(self.read_offset)
+            while len(lines) < max_lines:
+                data = self.file.readline()
+                if not data:
+                    break
+                number, _, text = data.decode('utf-8')[:-1].partition(' ')
+                lines.append(Line(number=int(number), text=text))
+            self.read_offset = self.file.tell()
+        self.count -= len(lines)
+        if not self.count:
+            self.clear()
+        return lines
+
+    def unread(self, lines):
+        """ Put lines returned by read back in front of the others. """
+        self.head[:0] = lines
+        self.count += len(lines)
+
+    def discard_through(self, number):
+        """ Drop the lines up to and including line number. """
+        while self.count:
+            lines = self.read(1000)
+            keep = lines[bisect.bisect_right(lines, number, key=lambda line: line.number):]
+            if keep:
+                self.unread(keep)
+                return
+
+    def clear(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.read_offset = 0
+        self.head = []
+        self.count = 0
+
+
+class BoundedInputStream(InputStream):
+    """
+    Logscan InputStream which keeps at most about max_lines unconsumed lines
+    in memory, or all of them if max_lines is None. The older unconsumed
+    lines are moved to a LineSpill, from which eventdemux.TrackingLogscan
+    matches them before the lines in memory, so no line is skipped.
+    """
+
+    max_lines = None
+    spill = None
+
+    def append_line(self, data):
+        super().append_line(data)
+        self.trim()
+
+    def trim(self):
+        # Spill in batches so that not every line moves the list
+        if self.max_lines is None or len(self.lines) <= self.max_lines + self.max_lines // 4:
+            return
+        if self.spill is None:
+            self.spill = LineSpill()
+        count = len(self.lines) - self.max_lines
+        self.spill.write(self.lines[:count])
+        del self.lines[:count]
+
+    def discard_through(self, number):
+        """ Drop the unconsumed lines up to and including line number. """
+        del self.lines[:bisect.bisect_right(self.lines, number, key=lambda line: line.number)]
+        if self.spill:
+            self.spill.discard_through(number)
+
+
+class EventStoreWriter(object):
+    """
+    File-like object which feeds the lines of one host's events2 stream into
+    the store while passing them through to another stream. While the store
+    is disabled, the lines are only counted.
+    """
+
+    def __init__(self, store, host, out=None):
+        self.store = store
+        self.host = host
+        self.out = out
+        self.line = 0
+
+    def write(self, text):
+        if self.out:
+            self.out.write(text)
+        if not self.store.enabled:
+            self.line += text.count('\n')
+            return
+        # The text is one or more complete lines
+        for line_text in text.split('\n')[:-1]:
+            self.line += 1
+            self.store.add_line(self.host, self.line, line_text)
+
+    def flush(self):
+        if self.out:
+            self.out.flush()
+
+
+class EventStore(object):
+    """
+    All events2 records of the cluster, indexed by
+    (host, object, resource, peer node id, volume).
+
+    The store is fed while the events2 streams are read, which happens both
+    while Logscan waits for events and when the store itself waits. Reading
+    the streams is serialized by the given lock.
+    """
+
+    def __init__(self, lock=None, enabled=True):
+        self.lock = lock or threading.Lock()
+        # Whether lines are parsed into records at all
+        self.enabled = enabled
+        self.records = []
+        self.index = {}
+        self.seq = 0
+        self.listeners = []
+        self.inputs = {}
+        # Records kept in memory; None keeps all
+        self.max_records = None
+        # Number of records which have been discarded
+        self.evicted = 0
+        # Objects with a "position" cursor whose newer records are needed,
+        # such as pending EventConditions
+        self.holders = weakref.WeakSet()
+        # A fatal.Interrupt which ends waits for the streams
+        self.interrupt = None
+
+    def require(self, feature):
+        """ Raise RuntimeError if the store is disabled, naming the feature which needs it. """
+        if not self.enabled:
+            raise RuntimeError('{} requires the event store; use drbdtest.setup(event_store=True) '
+                    'or --event-store'.format(feature))
+
+    def attach(self, inputs):
+        """ Read from the given Logscan InputStreams when pumping. """
+        self.inputs = dict(inputs)
+
+    def add_line(self, host, line, text):
+        record = parse_event_line(host, self.seq + 1, line, text)
+        if record is None:
+            return
+        self.seq += 1
+        self.records.append(record)
+        self.index.setdefault(record.key(), []).append(record)
+        for listener in self.listeners:
+            listener(record)
+        # Evict in batches so that not every record moves the lists
+        if self.max_records is not None and len(self.records) > self.max_records + self.max_records // 4:
+            self._evict(min(self.records[-self.max_records - 1].seq, self._held_position()))
+
+    def _evict(self, seq):
+        """ Discard the records up to and including the cursor seq. """
+        if not self.records or seq < self.records[0].seq:
+            return
+        count = min(seq - self.records[0].seq + 1, len(self.records))
+        del self.records[:count]
+        self.evicted += count
+        for key, records in list(self.index.items()):
+            n = bisect.bisect_right(records, seq, key=lambda record: record.seq)
+            if n == len(records):
+                del self.index[key]
+            else:
+                del records[:n]
+
+    def hold(self, holder):
+        """
+        Keep the records newer than holder.position over checkpoints for as
+        long as holder exists.
+        """
+        self.holders.add(holder)
+
+    def _held_position(self):
+        """ The oldest position which a holder still needs, or the newest record. """
+        positions = [holder.position for holder in list(self.holders)]
+        return min([position for position in positions if position is not None] + [self.seq])
+
+    def checkpoint(self):
+        """
+        Discard the records which are older than the positions of all
+        holders. Records which arrived before the checkpoint can then only
+        be found when a holder still needs them. The retention limit does
+        not discard records which a holder needs either.
+
+        :returns: the number of discarded records
+        """
+        with self.lock:
+            evicted = self.evicted
+            self._evict(self._held_position())
+            return self.evicted - evicted
+
+    def add_listener(self, listener):
+        """ Call listener with each new record. """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def cursor(self):
+        """ Return a position to pass as "after" to find only newer records. """
+        return self.seq
+
+    def _buckets(self, host, obj, resource, peer_node_id, volume):
+        key = (host, obj, resource, peer_node_id, volume)
+        if ANY not in key:
+            return [self.index.get(key, [])]
+
+        def matches(index_key):
+            return all(want is ANY or want == have for want, have in zip(key, index_key))
+        # Copy the items; another thread may add keys meanwhile
+        return [records for index_key, records in list(self.index.items()) if matches(index_key)]
+
+    def find(self, host=ANY, obj=ANY, resource=ANY, peer_node_id=ANY, volume=ANY,
+            action=None, after=None, **fields):
+        """
+        Return the records which match all given criteria, ordered by their
+        arrival. Field names are given with underscores instead of dashes,
+        for example find(obj='peer-device', replication='Established'). When
+        all of host, obj, resource, peer_node_id and volume are given, the
+        matching records are found with a single index lookup.
+
+        :param after: only consider records newer than this cursor
+        :returns: the matching records which are still kept, see checkpoint
+        """
+        fields = {key.replace('_', '-'): str(value) for key, value in fields.items()}
+        result = []
+        for records in self._buckets(host, obj, resource, peer_node_id, volume):
+            for record in records:
+                if after is not None and record.seq <= after:
+                    continue
+                if action is not None and record.action != action:
+                    continue
+                if all(record.fields.get(key) == value for key, value in fields.items()):
+                    result.append(record)
+        if len(result) > 1:
+            result.sort(key=lambda record: record.seq)
+        return result
+
+    def latest(self, **query):
+        """ Return the newest record matching query, or None. """
+        records = self.find(**query)
+        return records[-1] if records else None
+
+    def pump(self, timeout=0):
+        """
+        Read the available lines of all attached streams, waiting up to
+        timeout seconds for data. Returns True if any data was read.
+
+        With a timeout of 0, nothing is read while another thread is reading
+        the streams; that thread applies the new lines anyway.
+        """
+        if not self.lock.acquire(blocking=timeout != 0):
+            return False
+        try:
+            return self.pump_locked(timeout)
+        finally:
+            self.lock.release()
+
+    def pump_locked(self, timeout):
+        """ Like pump, for callers which already hold the lock. """
+        # Recorded streams which have ended are skipped, see replay
+        streams = {input.input: (label, input) for label, input in self.inputs.items()
+                if not getattr(input.input, 'exhausted', False)}
+        if not streams:
+            if self.inputs:
+                raise EOFError('all events inputs have ended')
+            return False
+        interrupt = self.interrupt
+        if interrupt:
+            interrupt.check()
+        ready = select.select(list(streams) + ([interrupt] if interrupt else []), [], [], timeout)[0]
+        if interrupt:
+            interrupt.check()
+        for stream in ready:
+            label, input = streams[stream]
+            # the streams are non-blocking, so this reads the available bytes
+            data = stream.read()
+            if data is None:
+                continue
+            if data:
+                for line_bytes in input.splitter.split(data):
+                    input.append_line(line_bytes)
+            elif input.splitter.has_remaining():
+                input.append_line(input.splitter.read_remaining())
+            elif not getattr(stream, 'exhausted', False):
+                raise EOFError('events input closed: {}'.format(label))
+        return bool(ready)
+
+    def wait(self, timeout=30, after=None, **query):
+        """
+        Wait until a record matching query (see find) arrives and return the
+        first match.
+
+        :param after: only consider records newer than this cursor; defaults
+            to considering all records
+        :raise TimeoutException: when no record matches in time
+        """
+        deadline = time.time() + timeout
+        while True:
+            seq = self.seq
+            records = self.find(after=after, **query)
+            if records:
+                return records[0]
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutException('Timeout waiting for event {}'.format(
+                    ' '.join('{}={}'.format(key, value) for key, value in sorted(query.items()))))
+            # Only look at the new records next time
+            after = seq
+            self.pump(remaining)
+
+    def records_after(self, seq):
+        """ Return the records newer than the cursor seq. """
+        if not self.records:
+            return []
+        return self.records[max(0, seq - self.records[0].seq + 1):]
+
+    def wait_all(self, conditions, timeout=30):
+        """
+        Wait until all conditions are satisfied. The conditions are evaluated
+        independently, so the order in which their events arrive does not
+        matter.
+
+        :returns: for each condition, the list of matching records
+        :raise TimeoutException: when a condition is not satisfied in time
+        :raise NegativeMatchException: when a forbidden pattern of a
+            condition matches a record of one of its hosts
+        """
+        self._wait_conditions(conditions, timeout, lambda: all(c.satisfied for c in conditions))
+        return [condition.records for condition in conditions]
+
+    def wait_any(self, conditions, timeout=30):
+        """
+        Wait until one of the conditions is satisfied. See wait_all.
+
+        :returns: (index, records) for the first satisfied condition
+        """
+        self._wait_conditions(conditions, timeout, lambda: any(c.satisfied for c in conditions))
+        index = next(i for i, condition in enumerate(conditions) if condition.satisfied)
+        return index, conditions[index].records
+
+    def _wait_conditions(self, conditions, timeout, done):
+        deadline = time.time() + timeout
+        checked = min(condition.after for condition in conditions)
+        while True:
+            seq = self.seq
+            for condition in conditions:
+                condition.check_forbidden(self.records_after(checked))
+            checked = seq
+
+            for condition in conditions:
+                condition.evaluate(self)
+            if done():
+                return
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutException('Timeout waiting for events:\n{}'.format('\n'.join(
+                    '  {}'.format(condition) for condition in conditions if not condition.satisfied)))
+            self.pump(remaining)
+
+
+class EventCondition(object):
+    """
+    A condition which is satisfied when, for each of a set of objects, a
+    record with the given fields has arrived after the condition's cursor.
+    Each object keeps its own position, so the condition does not depend on
+    the order of the events.
+    """
+
+    def __init__(self, queries, fields, after, forbidden=(), description=None):
+        """
+        :param queries: one EventStore.find query per object
+        :param fields: the fields and other find arguments to match
+        :param after: only records newer than this cursor count
+        :param forbidden: patterns which may not match any record of the
+            hosts of the objects while waiting
+        """
+        self.queries = queries
+        self.fields = fields
+        self.after = after
+        self.forbidden = list(forbidden)
+        self.forbidden_regex = patterns.compile_pattern(patterns.alternation(self.forbidden), True) \
+                if self.forbidden else None
+        self.description = description or ' '.join('{}={}'.format(key, value) for key, value in fields.items())
+        self.hosts = {query.get('host', ANY) for query in queries}
+        self.records = [None] * len(queries)
+        self._cursors = [after] * len(queries)
+
+    @property
+    def position(self):
+        """
+        The oldest record position this condition still needs, or None once
+        it is satisfied, see EventStore.hold.
+        """
+        return None if self.satisfied else self.after
+
+    @property
+    def satisfied(self):
+        return all(record is not None for record in self.records)
+
+    def evaluate(self, store):
+        for i, query in enumerate(self.queries):
+            if self.records[i] is not None:
+                continue
+            seq = store.seq
+            found = store.find(after=self._cursors[i], **query, **self.fields)
+            if found:
+                self.records[i] = found[0]
+            else:
+                self._cursors[i] = seq
+
+    def check_forbidden(self, records):
+        for record in records:
+            if record.seq <= self.after or (ANY not in self.hosts and record.host not in self.hosts):
+                continue
+            if self.forbidden_regex and self.forbidden_regex.search(record.text):
+                raise NegativeMatchException("Unexpected pattern '{}' matches at {}:{}".format(
+                    patterns.matching_pattern(self.forbidden, record.text, True), record.host, record.line))
+
+    def __repr__(self):
+        return self.description
+
@@ -0,0 +1,162 @@
+"""
+Time series of the counters which "drbdsetup events2 --statistics" reports.
+The counters of every record are appended to stats-<host>.csv in the log
+directory and kept in memory for the test, or only the newest samples if
+StatisticsRecorder.max_samples is set. Example:
+
+series = peer_device.statistics()
+log(max(series.mib_per_s('sent')))
+"""
+
+import array
+import csv
+import math
+import os
+
+# Counters in the order of the CSV columns. Sizes and byte counters are in
+# KiB; pending, unacked, al-writes and bm-writes count requests.
+stat_fields = ['size', 'read', 'written', 'al-writes', 'bm-writes', 'upper-pending', 'lower-pending',
+        'ap-in-flight', 'rs-in-flight', 'received', 'sent', 'out-of-sync', 'pending', 'unacked',
+        'done', 'dbdt1', 'eta']
+
+stat_field_set = frozenset(stat_fields)
+
+key_fields = ['timestamp', 'object', 'resource', 'peer-node-id', 'volume']
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+class TimeSeries(object):
+    """ The counters of one DRBD object over time, as arrays of floats. """
+
+    def __init__(self, key):
+        self.key = key
+        self.timestamps = array.array('d')
+        # Only the counters which have been reported so far
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, timestamp, fields):
+        length = len(self.timestamps)
+        self.timestamps.append(timestamp)
+        for field, value in fields.items():
+            if field in stat_field_set:
+                column = self.columns.get(field)
+                if column is None:
+                    column = self.columns[field] = array.array('d', [math.nan]) * length
+                column.append(_to_float(value))
+        for column in self.columns.values():
+            if len(column) == length:
+                column.append(math.nan)
+
+    def drop_oldest(self, count):
+        """ Discard the oldest count samples. """
+        del self.timestamps[:count]
+        for column in self.columns.values():
+            del column[:count]
+
+    def column(self, field):
+        """ The values of a counter; NaN where it was not reported. """
+        column = self.columns.get(field)
+        if column is None:
+            return array.array('d', [math.nan]) * len(self.timestamps)
+        return column
+
+    def rate(self, field):
+        """
+        The change of a counter per second between consecutive samples.
+        The result has one element less than the series; element i belongs
+        to timestamps[i + 1].
+        """
+        values = self.column(field)
+        result = array.array('d')
+        for i in range(1, len(values)):
+            elapsed = self.timestamps[i] - self.timestamps[i - 1]
+            result.append((values[i] - values[i - 1]) / elapsed if elapsed > 0 else math.nan)
+        return result
+
+    def mib_per_s(self, field):
+        """ The rate of a KiB counter, such as "sent" or "written", in MiB/s. """
+        return array.array('d', (rate / 1024 for rate in self.rate(field)))
+
+    def iops(self, field='al-writes'):
+        """
+        The rate of a request counter. events2 does not count application
+        requests, so by default this is the activity log update rate.
+        """
+        return self.rate(field)
+
+    def resync_eta(self):
+        """
+        The estimated seconds until out-of-sync reaches zero at the current
+        rate of decrease; infinite while it is not decreasing.
+        """
+        out_of_sync = self.column('out-of-sync')
+        result = array.array('d')
+        for i, rate in enumerate(self.rate('out-of-sync'), 1):
+            result.append(out_of_sync[i] / -rate if rate < 0 else math.inf)
+        return result
+
+
+class StatisticsRecorder(object):
+    """
+    Collects the statistics of all records of an EventStore into time series
+    and per-host CSV files.
+    """
+
+    def __init__(self, store, logdir):
+        self.logdir = logdir
+        # Samples kept in memory per series; the CSV files always get all
+        self.max_samples = None
+        self.series_by_key = {}
+        self.writers = {}
+        self.files = []
+        store.add_listener(self._record)
+
+    def _writer(self, host):
+        writer = self.writers.get(host)
+        if writer is None:
+            f = open(os.path.join(self.logdir, 'stats-{}.csv'.format(host)), 'w', newline='')
+            self.files.append(f)
+            writer = csv.writer(f)
+            writer.writerow(key_fields + stat_fields)
+            self.writers[host] = writer
+        return writer
+
+    def _record(self, record):
+        if record.timestamp is None or stat_field_set.isdisjoint(record.fields):
+            return
+
+        key = record.key()
+        series = self.series_by_key.get(key)
+        if series is None:
+            series = self.series_by_key[key] = TimeSeries(key)
+        series.append(record.timestamp, record.fields)
+        # Drop in batches so that not every sample moves the arrays
+        if self.max_samples is not None and len(series) > self.max_samples + self.max_samples // 4:
+            series.drop_oldest(len(series) - self.max_samples)
+
+        self._writer(record.host).writerow(
+                ['{:.6f}'.format(record.timestamp), record.obj, record.resource,
+                    '' if record.peer_node_id is None else record.peer_node_id,
+                    '' if record.volume is None else record.volume] +
+                # csv writes None as an empty field
+                list(map(record.fields.get, stat_fields)))
+
+    def series(self, host, obj, resource, peer_node_id, volume):
+        """ Return the TimeSeries for an EventRecord key; empty if there are no samples. """
+        return self.series_by_key.get((host, obj, resource, peer_node_id, volume)) or \
+                TimeSeries((host, obj, resource, peer_node_id, volume))
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+        self.writers = {}
@@ -0,0 +1,104 @@
+"""
+Fail fast when the kernel of a test node reports a fatal problem, such as
+an oops or a hung task. Instead of waiting for event timeouts, the pending
+event waits and the commands which are running on the nodes are interrupted
+and raise KernelFatalError.
+"""
+
+import contextlib
+import os
+import threading
+
+fatal_pattern = r'BUG:|Oops|general protection fault|Kernel panic|INFO: task \S+ blocked'
+
+
+class KernelFatalError(RuntimeError):
+    pass
+
+
+class Interrupt(object):
+    """
+    Interrupts the test once triggered. Waits which select on the event
+    streams also select on this object, which becomes readable when it is
+    triggered. Running commands are registered with track() so that they
+    can be killed.
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.reason = None
+        self.lock = threading.Lock()
+        # Per running command, the function which kills it
+        self.in_flight = {}
+        self.killed = set()
+        # Whether KernelFatalError has been raised, see reset
+        self.raised = False
+
+    def fileno(self):
+        return self.read_fd
+
+    def trigger(self, reason):
+        """
+        Interrupt all waits and kill the running commands. Returns False if
+        the interrupt had already been triggered.
+        """
+        with self.lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            in_flight = list(self.in_flight.items())
+            self.killed.update(token for token, _ in in_flight)
+        os.write(self.write_fd, b'!')
+        for _, kill in in_flight:
+            try:
+                kill()
+            except OSError:
+                pass
+        return True
+
+    def reset(self):
+        """
+        Clear the interrupt, so that the waits and commands of the cleanup
+        after the test has failed with KernelFatalError can run.
+        """
+        with self.lock:
+            if self.reason is None:
+                return
+            self.reason = None
+            self.raised = False
+        os.read(self.read_fd, 1)
+
+    def check(self):
+        """ Raise KernelFatalError if the interrupt has been triggered. """
+        if self.reason is not None:
+            self._raise()
+
+    def _raise(self, cause=None):
+        self.raised = True
+        if cause is not None:
+            raise KernelFatalError(self.reason) from cause
+        raise KernelFatalError(self.reason)
+
+    @contextlib.contextmanager
+    def track(self, kill):
+        """
+        Register a running command with the function which kills it. If the
+        command is killed by the interrupt, KernelFatalError is raised when
+        the block ends.
+        """
+        token = object()
+        with self.lock:
+            self.in_flight[token] = kill
+        try:
+            yield
+        except Exception as e:
+            if token in self.killed:
+                self._raise(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[token]
+                killed = token in self.killed
+                self.killed.discard(token)
+        if killed:
+            self._raise()
@@ -0,0 +1,78 @@
+"""
+Facts about a test host, gathered by the target helper "host-facts". The
+facts which do not change until the host reboots, except by installing
+packages, are cached in the directory containing the log directories of the
+tests, keyed by host name and boot id, so that consecutive tests against the
+same hosts can reuse them. The other facts, such as the network addresses,
+are probed at every setup. The facts in use are written to
+host-facts-<host>.json in the log directory of the test.
+"""
+
+import json
+import os
+
+from .drbdtestlogger import log
+
+# Facts which "host-facts static" provides. Cached facts which lack any of
+# these are probed again.
+static_keys = frozenset({'boot_id', 'os_id', 'os_version_id', 'drbd_package'})
+
+
+def cache_path(host, boot_id):
+    logdir = os.path.abspath(host.cluster.logdir)
+    return os.path.join(os.path.dirname(logdir), '.host-facts', '{}-{}.json'.format(host.name, boot_id))
+
+
+def load(host, prepare):
+    """
+    Return the facts for host. The current facts are probed together with
+    the shell command prepare; the static facts only if there are none
+    cached for the host's current boot.
+    """
+    facts = json.loads(host.run(['bash', '-c', prepare + '; exec "$0" current', host.helper_path('host-facts')],
+        return_stdout=True))
+
+    path = cache_path(host, facts['boot_id'])
+    static = _read(path)
+    if static is None:
+        static = json.loads(host.run_helper('host-facts', ['static'], return_stdout=True))
+        _store(path, static)
+    else:
+        log('{}: using cached host facts from {}'.format(host.name, path))
+
+    facts.update(static)
+    _store(os.path.join(host.cluster.logdir, 'host-facts-{}.json'.format(host.name)), facts)
+    return facts
+
+
+def invalidate(host, keys):
+    """
+    Drop static facts which have changed, such as the DRBD package after
+    installing a different one. They are probed again by the next load().
+    """
+    if not host.facts:
+        return
+
+    path = cache_path(host, host.facts['boot_id'])
+    static = _read(path) or {}
+    _store(path, {key: value for key, value in static.items() if key not in keys})
+    host.facts = {key: value for key, value in host.facts.items() if key not in keys}
+
+
+def _read(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            facts = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not static_keys <= facts.keys():
+        return None
+    return facts
+
+
+def _store(path, facts):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(facts, f, indent=4)
+    os.replace(tmp_path, path)
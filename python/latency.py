@@ -0,0 +1,173 @@
+"""
+Latency from administrative commands to the events which show their effect,
+for example from "drbdadm primary" to "role:Primary". Each command issued
+with Node.drbdadm is timestamped and paired with the first matching event of
+that node's resource. The event timestamps are taken on the hosts, so they
+are corrected by the offset of the host clock, which Cluster.measure_clock_offsets
+measures at setup. The latencies include the time to start the command over
+SSH.
+
+The distributions are written to latency.json in the log directory. Example:
+
+resource.cluster.latency.assert_budget('primary', 0.5)
+"""
+
+import io
+import json
+import math
+import os
+import statistics
+import threading
+import time
+
+from . import drbdtestlogger
+from .drbdtestlogger import log
+
+# Per drbdadm command: the object type, action (None for any) and field
+# value of the event which completes it
+command_events = {
+    'primary': ('resource', None, 'role', 'Primary'),
+    'secondary': ('resource', None, 'role', 'Secondary'),
+    'connect': ('connection', None, 'connection', 'Connected'),
+    'disconnect': ('connection', None, 'connection', 'StandAlone'),
+    'attach': ('device', None, 'disk', 'UpToDate'),
+    'detach': ('device', None, 'disk', 'Diskless'),
+    'invalidate': ('peer-device', None, 'replication', 'SyncTarget'),
+    'invalidate-remote': ('peer-device', None, 'replication', 'SyncSource'),
+    'down': ('resource', 'destroy', None, None),
+}
+
+# Commands whose event has not arrived after this many seconds are dropped
+pending_timeout = 120
+
+clock_samples = 5
+
+
+def measure_clock_offset(host):
+    """
+    Return the offset of the host clock to the local clock in seconds. The
+    sample with the shortest round trip is used.
+    """
+    best = None
+    for _ in range(clock_samples):
+        out = io.StringIO()
+        before = time.time()
+        host.execute('date +%s.%N', stdout=out, stderr=drbdtestlogger.logstream)
+        after = time.time()
+        remote = float(out.getvalue())
+        if best is None or after - before < best[0]:
+            best = (after - before, remote - (before + after) / 2)
+    return best[1]
+
+
+def percentile(values, p):
+    """ The p-th percentile of values, by the nearest rank. """
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+class PendingCommand(object):
+    def __init__(self, host, verb, resource, issued):
+        self.host = host
+        self.verb = verb
+        self.resource = resource
+        self.issued = issued
+        self.obj, self.action, self.field, self.value = command_events[verb]
+
+    def matches(self, record):
+        return record.host == self.host and record.resource == self.resource and \
+                record.obj == self.obj and \
+                (self.action is None or record.action == self.action) and \
+                (self.field is None or record.fields.get(self.field) == self.value)
+
+
+class LatencyRecorder(object):
+    """ Pairs drbdadm commands with the events of an EventStore. """
+
+    def __init__(self, store, logdir):
+        self.store = store
+        self.logdir = logdir
+        self.clock_offsets = {}
+        self.pending = []
+        self.samples = {}
+        self.lock = threading.Lock()
+        store.add_listener(self._record)
+
+    def clock_offset(self, host):
+        """ The offset of the clock of host, measured on first use. Blocks for the measurement. """
+        offset = self.clock_offsets.get(host.name)
+        if offset is None:
+            offset = self.clock_offsets[host.name] = measure_clock_offset(host)
+            log('{}: clock offset {:+.6f}s'.format(host.name, offset))
+        return offset
+
+    def command_issued(self, host, resource_name, cmd):
+        """
+        Note that the drbdadm command cmd, given as a list, is being started.
+        Does not block; the events of hosts whose clock offset has not been
+        measured are taken as they are.
+        """
+        if not self.store.enabled:
+            return
+        verb = next((word for word in cmd if not word.startswith('-')), None)
+        if verb not in command_events:
+            return
+        with self.lock:
+            self.pending.append(PendingCommand(host.name, verb, resource_name, time.time()))
+
+    def _record(self, record):
+        if not self.pending or record.timestamp is None:
+            return
+        with self.lock:
+            offset = self.clock_offsets.get(record.host, 0.0)
+            event_time = record.timestamp - offset
+            remaining = []
+            for command in self.pending:
+                if event_time >= command.issued and command.matches(record):
+                    self.samples.setdefault(command.verb, []).append(event_time - command.issued)
+                elif event_time - command.issued < pending_timeout:
+                    remaining.append(command)
+            self.pending = remaining
+
+    def summary(self):
+        """ Per command, the number of samples and the latency distribution in seconds. """
+        result = {}
+        for verb, values in sorted(self.samples.items()):
+            result[verb] = {
+                'count': len(values),
+                'min': min(values),
+                'median': statistics.median(values),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': max(values),
+                'samples': values,
+            }
+        return result
+
+    def assert_budget(self, verb, max_seconds, p=100):
+        """
+        Raise RuntimeError if the p-th percentile of the latencies of the
+        command verb exceeds max_seconds, or if there are no samples.
+        """
+        self.store.require('assert_budget')
+        self.store.pump()
+        values = self.samples.get(verb)
+        if not values:
+            raise RuntimeError('No latency samples for {}'.format(verb))
+        value = percentile(values, p)
+        if value > max_seconds:
+            raise RuntimeError('Latency of {} is {:.3f}s at p{}, budget {:.3f}s'.format(
+                verb, value, p, max_seconds))
+        log('Latency of {} is {:.3f}s at p{} (budget {:.3f}s)'.format(verb, value, p, max_seconds))
+
+    def write_clock_offsets(self):
+        """ Write the clock offsets measured so far to clock-offsets.json in the log directory. """
+        with open(os.path.join(self.logdir, 'clock-offsets.json'), 'w') as f:
+            json.dump(self.clock_offsets, f, indent=2)
+
+    def write(self):
+        """ Write latency.json to the log directory, if there are samples. """
+        if not self.samples:
+            return
+        with open(os.path.join(self.logdir, 'latency.json'), 'w') as f:
+            json.dump({'clock_offsets': self.clock_offsets, 'commands': self.summary()}, f, indent=2)
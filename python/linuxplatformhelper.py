@@ -1,8 +1,8 @@
 from subprocess import CalledProcessError
-import os
 import re
 import time
 import inspect
+from . import hostfacts
 from .drbdtestlogger import log
 
 drbd_config_dir_linux_default = '/var/lib/drbd-test'
@@ -16,14 +16,16 @@ class LinuxPlatformHelper(object):
         host.backing_device = backing_device
         host.drbd_config_dir = drbd_config_dir_linux_default
 
-        host.os_id, host.os_version_id = host.run(
-                ['bash', '-c', '. /etc/os-release ; echo $ID ; echo $VERSION_ID'],
-                return_stdout=True).splitlines()
+        host.cluster.artifacts.add_command(host, ["journalctl", "-u", "tlshd", "-b", "0", "-q"],
+                'tlshd-{}'.format(host.name), keep_empty=False)
+
+        host.os_id = host.facts['os_id']
+        host.os_version_id = host.facts['os_version_id']
 
         host.addr = get_default_addr(host)
         host.addrs = [host.addr]
 
-        addresses = host.run(['ip', '-oneline', 'addr', 'show'], return_stdout=True)
+        addresses = host.facts['addresses']
         log("got all addresses %s", addresses)
         for line in addresses.splitlines():
             m = re.search(r'^\s*\d+:\s+(\w+)\s+inet\s+([\d\.]+)/(\d+)', line)
@@ -78,22 +80,32 @@ class LinuxPlatformHelper(object):
     def read_drbd_version(self, host):
         # cat > /dev/kmsg so we have it in the dmesg stream,
         # even if the ring buffer wrapped since the module was loaded
-        host.run(['bash', '-c', 'cat /proc/drbd > /dev/kmsg || modprobe drbd'])
-        proc_drbd_lines = host.run(['cat', '/proc/drbd'], return_stdout=True).splitlines()
+        host.facts = hostfacts.load(host, 'cat /proc/drbd > /dev/kmsg || modprobe drbd')
+        # null if /proc/drbd could not be read
+        proc_drbd = host.facts['proc_drbd']
+        proc_drbd_lines = proc_drbd.splitlines() if proc_drbd else []
+        if len(proc_drbd_lines) < 2:
+            raise RuntimeError('{}: cannot read the DRBD version, /proc/drbd is missing or incomplete: {!r}'.format(
+                host.name, proc_drbd))
         version_line = proc_drbd_lines[0]
         git_hash_line = proc_drbd_lines[1]
 
         version_line_match = re.match(r'version: ([^ -]+).*', version_line)
-        host.drbd_version = version_line_match.group(1)
-
         # out-of-tree drbd uses "GIT-hash: 0a1b2c3d",
         # in-tree uses "srcversion: 0A1B2C3D"; allow both formats.
         hash_match = re.match(r'(?:srcversion|GIT-hash): ([0-9A-Fa-f]+).*', git_hash_line)
+        if not version_line_match or not hash_match:
+            raise RuntimeError('{}: cannot parse the DRBD version from /proc/drbd: {!r}'.format(
+                host.name, proc_drbd))
+        host.drbd_version = version_line_match.group(1)
         host.drbd_git_hash = hash_match.group(1).lower()
 
         version_match = re.match(r'([0-9]+)\.([0-9]+)\.([0-9]+).*', host.drbd_version)
         host.drbd_version_tuple = int(version_match.group(1)), int(version_match.group(2)), int(version_match.group(3))
 
+    def invalidate_drbd_facts(self, host):
+        hostfacts.invalidate(host, ['drbd_package'])
+
     def native_filename(self, host, filename):
         return filename
 
@@ -103,11 +115,6 @@ class LinuxPlatformHelper(object):
         run.
         """
 
-        tlshd_log = host.run(["journalctl", "-u", "tlshd", "-b", "0", "-q"], return_stdout=True)
-        if tlshd_log:
-            with open(os.path.join(host.cluster.logdir, 'tlshd-{}'.format(host.name)), "w") as tlshd_logfile:
-                tlshd_logfile.write(tlshd_log)
-
         cleanup_iptables = ["bash", "--norc", "-xec", inspect.cleandoc('''
             iptables -D INPUT -j drbd-test-input
             iptables -D OUTPUT -j drbd-test-output
@@ -127,23 +134,13 @@ class LinuxPlatformHelper(object):
                 host.dmesg_pid_trap.first_message.strip())])
 
     def rmmod(self, host):
-        if host.drbd_version_tuple >= (9, 0, 0):
-            # might not even be loaded
-            try:
-                host.run(['rmmod', 'drbd_transport_tcp'])
-            except:
-                pass
-            try:
-                host.run(['rmmod', 'drbd_transport_lb-tcp'])
-            except:
-                pass
-            try:
-                host.run(['rmmod', 'drbd_transport_rdma'])
-            except:
-                pass
-
         try:
-            host.run(['rmmod', 'drbd'])
+            with host.batch() as batch:
+                if host.drbd_version_tuple >= (9, 0, 0):
+                    # might not even be loaded
+                    for transport in ['drbd_transport_tcp', 'drbd_transport_lb-tcp', 'drbd_transport_rdma']:
+                        batch.run(['rmmod', transport], catch=True)
+                batch.run(['rmmod', 'drbd'])
         except CalledProcessError as e:
             host.run(['cat', '/sys/kernel/debug/drbd/reference_counts'], catch=True)
             raise e
@@ -178,15 +175,17 @@ class LinuxPlatformHelper(object):
             node.run(cmdline)
             time.sleep(lead_seconds)
         else:
-            for c in cmds:
-                node.run(c)
+            with node.batch() as batch:
+                for c in cmds:
+                    batch.run(c)
 
     def unblock_path(self, node, other_node, net_number=0, jump_to="DROP"):
         """Uses iptables to unblock one network path."""
         log("Unblocking path #%d from %s to %s" % (net_number, node, other_node))
         cmds = node._iptables_cmd(other_node, jump_to, net_number, "-D")
-        for c in cmds:
-            node.run(c)
+        with node.batch() as batch:
+            for c in cmds:
+                batch.run(c)
 
     def prepare_auto_promote(self, node):
         pass
@@ -225,13 +224,16 @@ class LinuxPlatformHelper(object):
 
 
 def get_default_addr(host):
-    try:
-        # Use 'get 1' to query the default route's src address.
-        # Older iproute2 rejects 0.0.0.1, but '1' works everywhere.
-        route_out = host.run(['ip', '-4', 'route', 'get', '1'], return_stdout=True)
-    except CalledProcessError as e:
-        log('Could not get default route for host {}'.format(host.name))
-        raise
+    # Use 'get 1' to query the default route's src address.
+    # Older iproute2 rejects 0.0.0.1, but '1' works everywhere.
+    route_out = host.facts['default_route']
+    if route_out is None:
+        # The facts probe failed to get it; run the command for its error
+        try:
+            route_out = host.run(['ip', '-4', 'route', 'get', '1'], return_stdout=True)
+        except CalledProcessError as e:
+            log('Could not get default route for host {}'.format(host.name))
+            raise
 
     route_words = route_out.strip().split(' ')
     src_addrs = [value
@@ -0,0 +1,237 @@
+"""
+Log files in the log directory, optionally compressed with gzip or zstd while
+they are written. Compressed files get the suffix .gz or .zst. The compressed
+streams are flushed at most every flush_interval seconds, and at the latest
+flush_interval seconds after a write, so that a log is readable up to the
+last flush point even if the test is killed. flush_all flushes all of them
+at once, for example at exit.
+
+open_log reads a log whichever way it was written, including logs which end
+without a proper end of stream.
+"""
+
+import atexit
+import gzip
+import io
+import os
+import shutil
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# None, 'gzip' or 'zstd'; set from --log-compression
+compression = None
+
+suffixes = {'gzip': '.gz', 'zstd': '.zst'}
+
+flush_interval = 5
+
+gzip_level = 6
+zstd_level = 3
+
+# The open CompressedWriters, see flush_all
+open_writers = set()
+open_writers_lock = threading.Lock()
+
+
+def set_compression(method):
+    """ Compress the logs which are opened from now on with method ('none', 'gzip' or 'zstd'). """
+    global compression
+    if method == 'none':
+        method = None
+    if method == 'zstd' and zstandard is None:
+        raise RuntimeError('zstd log compression requires the zstandard module')
+    compression = method
+
+
+def _compressor(raw, method):
+    """ Return (stream, flush) for a binary stream compressing to raw. """
+    if method == 'gzip':
+        stream = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=gzip_level)
+        return stream, stream.flush
+    stream = zstandard.ZstdCompressor(level=zstd_level).stream_writer(raw, closefd=False)
+    return stream, lambda: stream.flush(zstandard.FLUSH_BLOCK)
+
+
+class CompressedWriter(object):
+    """ Text file object which writes a compressed log. """
+
+    def __init__(self, path, mode, method):
+        self.raw = open(path, mode + 'b')
+        self.stream, self._flush_point = _compressor(self.raw, method)
+        self.last_flush = time.time()
+        # Whether data has been written since the last flush point
+        self.pending = False
+        # Flushes pending data once the log goes idle
+        self.timer = None
+        # Several threads write to the test log
+        self.lock = threading.Lock()
+        with open_writers_lock:
+            open_writers.add(self)
+
+    def write(self, text):
+        with self.lock:
+            if self.raw.closed:
+                # Late messages at exit
+                return
+            self.stream.write(text.encode('utf-8'))
+            self.pending = True
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() - self.last_flush >= flush_interval:
+            self._flush()
+        elif self.pending and self.timer is None:
+            self.timer = threading.Timer(self.last_flush + flush_interval - time.time(), self._flush_idle)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush(self):
+        self._flush_point()
+        self.raw.flush()
+        self.last_flush = time.time()
+        self.pending = False
+
+    def _flush_idle(self):
+        with self.lock:
+            self.timer = None
+            if not self.raw.closed and self.pending:
+                self._flush()
+
+    def flush(self):
+        """ Flushes are rate limited, since the test log is flushed after every line. """
+        with self.lock:
+            self._maybe_flush()
+
+    def flush_now(self):
+        """ Flush regardless of the rate limit. """
+        with self.lock:
+            if not self.raw.closed and self.pending:
+                self._flush()
+
+    def close(self):
+        with open_writers_lock:
+            open_writers.discard(self)
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.raw.closed:
+                return
+            self.stream.close()
+            self.raw.close()
+
+    @property
+    def closed(self):
+        return self.raw.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_log_writer(path, mode='w'):
+    """
+    Open a log file for writing text, compressed if compression is set. The
+    suffix of the compression is appended to path. Appending to a compressed
+    log adds a new compressed member to it.
+    """
+    if compression is None:
+        return open(path, mode, encoding='utf-8')
+    return CompressedWriter(path + suffixes[compression], mode, compression)
+
+
+def flush_all():
+    """ Flush all open compressed logs, regardless of the rate limit. """
+    with open_writers_lock:
+        writers = list(open_writers)
+    for writer in writers:
+        writer.flush_now()
+
+
+# Also covers the logs which are still open when the test exits
+atexit.register(flush_all)
+
+
+def compress_file(path):
+    """ Replace an uncompressed file by its compressed form, if compression is set. """
+    if compression is None or not os.path.isfile(path):
+        return
+    writer = CompressedWriter(path + suffixes[compression], 'w', compression)
+    try:
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, writer.stream)
+    finally:
+        writer.close()
+    os.remove(path)
+
+
+def log_name(filename):
+    """ Return the name of a log file without the compression suffix. """
+    for suffix in suffixes.values():
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def find_log(path):
+    """ Return the path of the log path, which may have a compression suffix. """
+    for candidate in [path] + [path + suffix for suffix in suffixes.values()]:
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(path)
+
+
+class _TruncatedReader(io.RawIOBase):
+    """ Treats a compressed stream which ends early, such as after a crash, as ended. """
+
+    def __init__(self, raw, stream):
+        self.raw = raw
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def readinto(self, buffer):
+        try:
+            # read1 returns the data before a truncation rather than losing it
+            data = self.stream.read1(len(buffer))
+        except EOFError:
+            data = b''
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.stream.close()
+        self.raw.close()
+        super().close()
+
+
+def open_log(path, binary=False):
+    """
+    Open the log path for reading, decompressing it if it was written
+    compressed. Returns a text file object unless binary is set.
+    """
+    path = find_log(path)
+    raw = open(path, 'rb')
+    if path.endswith(suffixes['gzip']):
+        stream = io.BufferedReader(_TruncatedReader(raw, gzip.GzipFile(fileobj=raw, mode='rb')))
+    elif path.endswith(suffixes['zstd']):
+        if zstandard is None:
+            raise RuntimeError('Reading {} requires the zstandard module'.format(path))
+        stream = io.BufferedReader(_TruncatedReader(raw,
+            zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)))
+    else:
+        stream = raw
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream, encoding='utf-8', errors='backslashreplace')
@@ -13,6 +13,7 @@ Rob Speer's changes are as follows:
     - index() just returns the index of an item
     - added a __getstate__ and __setstate__ so it can be pickled
     - added __getitem__
+    - added a version counter which changes whenever the content changes
 """
 import collections.abc
 
@@ -43,6 +44,7 @@ class OrderedSet(collections.abc.MutableSet):
     def __init__(self, iterable=None):
         self.items = []
         self.map = {}
+        self.version = 0
         if iterable is not None:
             for e in iter(iterable):
                 self.add(e)
@@ -110,6 +112,7 @@ class OrderedSet(collections.abc.MutableSet):
         if key not in self.map:
             self.map[key] = len(self.items)
             self.items.append(key)
+            self.version += 1
         return self.map[key]
     append = add
 
@@ -143,6 +146,7 @@ class OrderedSet(collections.abc.MutableSet):
         self.map.pop(key, None)
         try:
             self.items.remove(key)
+            self.version += 1
         except:
             pass
 
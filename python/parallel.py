@@ -0,0 +1,90 @@
+"""
+Run independent calls concurrently, typically one per node or host, so that
+their SSH round trips overlap.
+"""
+
+import concurrent.futures
+import contextlib
+import subprocess
+import traceback
+
+from . import drbdtestlogger
+
+
+class ParallelError(RuntimeError):
+    """ Several of a set of concurrent calls failed. """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__('{} parallel call(s) failed:\n{}'.format(
+            len(failures),
+            '\n'.join('  {}: {!r}'.format(label, e) for label, e in failures)))
+
+
+def log_failure(label, e):
+    """ Log the traceback of a failed call, and the output of a failed command. """
+    print('{}: failed:'.format(label), file=drbdtestlogger.logstream)
+    if isinstance(e, subprocess.CalledProcessError) and e.output is not None:
+        output = e.output
+        if isinstance(output, bytes):
+            output = output.decode(encoding='utf-8', errors='backslashreplace')
+        drbdtestlogger.logstream.write(output)
+    traceback.print_exception(type(e), e, e.__traceback__, file=drbdtestlogger.logstream)
+
+
+def run_parallel(calls, max_workers=None):
+    """
+    Run calls concurrently on a thread pool and return their results in the
+    order of the calls.
+
+    The log output of each call is collected while it runs and written in the
+    order of the calls once all of them have finished, so the output of
+    different calls is not interleaved.
+
+    :param calls: list of (label, function) pairs; each function is called
+        without arguments and the label names the call in error messages
+    :param max_workers: maximum number of threads; defaults to one per call
+    :raise: after all calls have finished, the exception of the failed call
+        if exactly one call failed, or ParallelError from the first failure
+        if several calls failed; then the traceback of each failure is
+        logged.
+    """
+    if not calls:
+        return []
+
+    def call(func):
+        captured = []
+        capture = drbdtestlogger.logstream.capture() \
+                if drbdtestlogger.logstream else contextlib.nullcontext(captured)
+        with capture as captured:
+            try:
+                return func(), None, captured
+            except Exception as e:
+                return None, e, captured
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(calls)) as executor:
+        futures = [executor.submit(call, func) for _, func in calls]
+        outcomes = [future.result() for future in futures]
+
+    results = []
+    failures = []
+    for (label, _), (result, error, captured) in zip(calls, outcomes):
+        if captured:
+            drbdtestlogger.logstream.write(''.join(captured))
+        if error is not None:
+            failures.append((label, error))
+        results.append(result)
+
+    if drbdtestlogger.logstream:
+        # A single failure is raised with its own traceback
+        if len(failures) > 1:
+            for label, e in failures:
+                log_failure(label, e)
+        drbdtestlogger.logstream.flush()
+
+    if len(failures) == 1:
+        raise failures[0][1]
+    if failures:
+        raise ParallelError(failures) from failures[0][1]
+
+    return results
@@ -0,0 +1,110 @@
+"""
+Caching of the regular expressions used for event matching. Compiled
+patterns are kept by (pattern, wordwise), so that repeated waits for the same
+patterns do not compile them again. Sets of forbidden patterns are combined
+into one alternation, which is rebuilt only when the set changes.
+
+CachingLogscan is a Logscan which compiles the patterns of its waits through
+the cache.
+"""
+
+import functools
+import re
+import time
+
+from lbpytest.logscan import EventContext, Logscan, NegativeMatchException, PatternSet, SearchGoal
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(pattern, wordwise):
+    if wordwise:
+        pattern = '\\b' + pattern + '\\b'
+    return re.compile(pattern)
+
+
+def compile_patterns(patterns, wordwise):
+    """ Like lbpytest.logscan.compile_patterns, but using the cache. """
+    if not patterns:
+        return []
+    return [compile_pattern(pattern, wordwise) for pattern in patterns]
+
+
+def alternation(patterns):
+    """
+    Combine patterns into one which matches wherever any of them matches.
+    The alternation is grouped, so that word boundaries added around it
+    apply to each of the patterns.
+    """
+    return '(?:' + '|'.join('(?:{})'.format(pattern) for pattern in patterns) + ')'
+
+
+def set_alternation(pattern_set):
+    """
+    Return the alternation of an OrderedSet of patterns. The result is kept
+    with the set and rebuilt only when the set's version has changed.
+    """
+    cached = getattr(pattern_set, '_alternation', None)
+    if cached is None or cached[0] != pattern_set.version:
+        cached = (pattern_set.version, alternation(pattern_set))
+        pattern_set._alternation = cached
+    return cached[1]
+
+
+def matching_pattern(patterns, text, wordwise):
+    """ Return the first of patterns which matches text, or None. """
+    for pattern in patterns:
+        if compile_pattern(pattern, wordwise).search(text):
+            return pattern
+    return None
+
+
+class CachingLogscan(Logscan):
+    """
+    Logscan which compiles the patterns of its waits through the cache. The
+    NegativeMatchExceptions it raises carry the text of the matching line as
+    "text".
+    """
+
+    def _match_line(self, context, label, line):
+        try:
+            super()._match_line(context, label, line)
+        except NegativeMatchException as e:
+            e.text = line.text
+            raise
+
+    def event(self, yes, no=[], always_no=[], filters={}, wordwise=False, timeout=None, verbose_out=None):
+        """ See Logscan.event. """
+        for label in filters.keys():
+            if label not in self.inputs:
+                raise ValueError('filter for unknown label {}'.format(label))
+
+        line_start = {label: input.lines[0].number if input.lines else input.line_number
+            for label, input in self.inputs.items()}
+
+        regexes_yes = compile_patterns(yes, wordwise)
+        regexes_filter = {
+                label: [PatternSet(compile_patterns(filter_set, wordwise)) for filter_set in label_filters]
+                for label, label_filters in filters.items()}
+
+        context = EventContext(
+                verbose_out=verbose_out,
+                line_start=line_start,
+                regexes_no=compile_patterns(no, wordwise),
+                regexes_always_no=compile_patterns(always_no, wordwise),
+                regexes_pending={
+                    label: [SearchGoal(regex, filter) for regex in regexes_yes for filter in label_filters]
+                    for label, label_filters in regexes_filter.items()},
+                matches=[])
+        self._print_waiting_for(context, regexes_yes, regexes_filter)
+
+        # Match any lines captured in a previous wait
+        self._match_lines(context)
+
+        timeout = timeout if timeout is not None else self.timeout
+        start = time.time()
+        while context.regexes_pending:
+            remaining = max(0., timeout - (time.time() - start))
+            self._read_input(context, remaining)
+            self._match_lines(context)
+
+        return context.matches
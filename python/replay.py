@@ -0,0 +1,161 @@
+"""
+Replay of recorded events-<host> files through the event matching machinery,
+without any hosts. The recorded lines are fed to Logscan and the EventStore
+as fast as they can be read, so event-wait sequences can be checked and
+benchmarked locally. Example:
+
+cluster = replay.replay_cluster('log/my-test-20240101-120000')
+cluster.logscan([r'peer-device .* replication:Established'], {'alpha': [[]]})
+
+From the command line, run from the top directory of the repository:
+
+python3 -m python.replay log/my-test-20240101-120000 --wait 'replication:Established'
+"""
+
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+from lbpytest.logscan import InputStream, NegativeMatchException, TimeoutException
+
+from . import drbdtest, drbdtestlogger, events, logfiles, patterns
+from .drbdtestlogger import log
+
+chunk_size = 1 << 20
+
+
+class RecordedStream(object):
+    """
+    A recorded file which can stand in for the stdout of a live events2
+    process. It is always ready for select and read() returns the next
+    chunk, or b'' at the end of the recording.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = logfiles.open_log(path, binary=True)
+        self.exhausted = False
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def read(self, size=-1):
+        data = self.f.read(chunk_size if size is None or size < 0 else size)
+        if not data:
+            self.exhausted = True
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class ReplayLogscan(patterns.CachingLogscan):
+    """
+    Logscan over recorded streams. Reads the next chunk of every recording
+    which has not ended instead of waiting for data. A wait which is still
+    pending when all recordings have ended fails like a timeout.
+    """
+
+    def _read_input(self, context, remaining):
+        inputs = [input for input in self.inputs.values() if not input.input.exhausted]
+        if not inputs:
+            raise TimeoutException(self._timeout_message(context) + '\n(end of recording)')
+
+        for input in inputs:
+            data = input.input.read()
+            if data:
+                for line_bytes in input.splitter.split(data):
+                    input.append_line(line_bytes)
+            elif input.splitter.has_remaining():
+                input.append_line(input.splitter.read_remaining())
+
+
+def recorded_hosts(logdir):
+    """ Return the names of the hosts which have an events file in logdir. """
+    prefix = os.path.join(logdir, 'events-')
+    names = {logfiles.log_name(path[len(prefix):]) for path in glob.glob(prefix + '*')}
+    # The unfiltered events, see target/events-filter
+    return sorted(name for name in names if not name.startswith('full-'))
+
+
+def replay_cluster(logdir, host_names=None, outdir=None, timeout=30):
+    """
+    Return a Cluster without hosts whose event streams are the recorded
+    events files from logdir. Waits which do not match before the
+    recordings end raise TimeoutException.
+
+    :param host_names: the hosts to replay; defaults to all recorded hosts
+    :param outdir: where files such as the statistics are written; defaults
+        to a new temporary directory
+    """
+    if host_names is None:
+        host_names = recorded_hosts(logdir)
+    if not host_names:
+        raise RuntimeError('No events files found in {}'.format(logdir))
+    if outdir is None:
+        outdir = tempfile.mkdtemp(prefix='drbd-replay-')
+
+    cluster = drbdtest.Cluster(job='replay', logdir=outdir, drbd_version=None, drbd_version_other=None,
+            resource_name=None, transport=None, tls=None, event_store=True)
+
+    inputs = {name: InputStream(RecordedStream(os.path.join(logdir, 'events-' + name)),
+                tee_out=events.EventStoreWriter(cluster.event_store, name))
+            for name in host_names}
+    cluster.logscan_events = ReplayLogscan(inputs, timeout=timeout)
+    cluster.event_store.attach(inputs)
+    return cluster
+
+
+def read_all(cluster):
+    """ Feed the remaining recorded lines into the EventStore. """
+    with cluster.logscan_lock:
+        for input in cluster.logscan_events.inputs.values():
+            while True:
+                data = input.input.read()
+                if not data:
+                    break
+                for line_bytes in input.splitter.split(data):
+                    input.append_line(line_bytes)
+                # Nothing waits for these lines any more
+                input.lines = []
+            if input.splitter.has_remaining():
+                input.append_line(input.splitter.read_remaining())
+            input.lines = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded events files')
+    parser.add_argument('logdir', help='log directory containing events-<host> files')
+    parser.add_argument('--host', action='append', help='host to replay; may be given multiple times')
+    parser.add_argument('--wait', action='append', default=[],
+            help='pattern to wait for on all hosts, in order; may be given multiple times')
+    parser.add_argument('--forbid', action='append', default=[],
+            help='pattern which may not appear while waiting; may be given multiple times')
+    args = parser.parse_args()
+
+    drbdtestlogger.logstream = drbdtestlogger.Tee()
+    drbdtestlogger.logstream.add(sys.stdout)
+
+    cluster = replay_cluster(args.logdir, args.host)
+    filters = {name: [[]] for name in cluster.logscan_events.inputs}
+
+    start = time.time()
+    try:
+        for pattern in args.wait:
+            cluster.logscan([pattern], filters, always_no=args.forbid)
+    except (TimeoutException, NegativeMatchException) as e:
+        log(e)
+        sys.exit(1)
+    read_all(cluster)
+    elapsed = time.time() - start
+
+    records = cluster.event_store.seq
+    log('Replayed {} records from {} host(s) in {:.3f}s ({:.0f} records/s)'.format(
+        records, len(filters), elapsed, records / elapsed if elapsed > 0 else 0))
+
+
+if __name__ == '__main__':
+    main()
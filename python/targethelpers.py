@@ -0,0 +1,49 @@
+"""
+Packaging of the helper scripts in target/ for installation on the test
+hosts. All helpers are shipped as one archive which is unpacked into a
+directory named after the hash of its content. A host which already has that
+directory from an earlier run does not need another upload.
+"""
+
+import base64
+import functools
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+
+target_dir = 'target'
+remote_dir_prefix = '/tmp/drbd-test-helpers-'
+complete_marker = '.complete'
+
+
+@functools.lru_cache(maxsize=None)
+def helper_archive():
+    """
+    Build the helper archive.
+
+    :returns: (digest, archive) where archive is the base64 encoded tar.gz
+    """
+    tar_data = io.BytesIO()
+    with tarfile.open(fileobj=tar_data, mode='w') as tar:
+        for name in sorted(os.listdir(target_dir)):
+            path = os.path.join(target_dir, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                content = f.read()
+            # Normalize everything except name, mode and content so that the
+            # digest only changes when the helpers do
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(content))
+
+    digest = hashlib.sha256(tar_data.getvalue()).hexdigest()
+    archive = gzip.compress(tar_data.getvalue(), mtime=0)
+    return digest, base64.encodebytes(archive).decode('ascii')
+
+
+def remote_dir(digest):
+    return remote_dir_prefix + digest[:16]
@@ -0,0 +1,108 @@
+"""
+Merge the logs of a test run into one time-ordered timeline. The sources are
+the kernel logs (dmesg-<host>), the events2 streams (events-<host>) and the
+test log with timestamps (test-timestamps.log), compressed or not. The host
+timestamps are corrected by the clock offsets in clock-offsets.json, if
+present. The files are read line by line and merged, so that memory use does
+not depend on their size.
+
+From the command line, run from the top directory of the repository:
+
+python3 -m python.timeline log/my-test-20240101-120000
+"""
+
+import argparse
+import datetime
+import glob
+import heapq
+import json
+import os
+
+from . import logfiles
+
+# Sources in the order in which lines with equal timestamps are merged
+source_kinds = [('dmesg-', 'dmesg'), ('events-', 'events')]
+
+
+def parse_timestamp(word):
+    """ Return the seconds since the epoch of an ISO 8601 timestamp, or None. """
+    try:
+        # dmesg --time-format=iso separates the fraction with a comma, which
+        # fromisoformat only accepts from Python 3.11 on
+        return datetime.datetime.fromisoformat(word.replace(',', '.', 1)).timestamp()
+    except ValueError:
+        return None
+
+
+def read_source(path, label, offset, order):
+    """
+    Yield (time, order, line number, label, text) for each line of a log
+    file whose lines begin with ISO 8601 timestamps. Lines without a
+    timestamp, such as continuation lines, get the time of the preceding
+    line.
+    """
+    timestamp = None
+    with logfiles.open_log(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip('\n')
+            word, _, rest = line.partition(' ')
+            parsed = parse_timestamp(word) if word[:1].isdigit() else None
+            if parsed is not None:
+                timestamp = parsed - offset
+                line = rest
+            if timestamp is None:
+                # Nothing to order by before the first timestamp
+                continue
+            yield (timestamp, order, number, label, line)
+
+
+def sources(logdir, clock_offsets):
+    """ Return the line iterators of all sources in logdir. """
+    result = []
+    try:
+        result.append(read_source(logfiles.find_log(os.path.join(logdir, 'test-timestamps.log')), 'test', 0.0, 0))
+    except FileNotFoundError:
+        pass
+    for order, (prefix, kind) in enumerate(source_kinds, 1):
+        for path in sorted(glob.glob(os.path.join(logdir, prefix + '*'))):
+            host = logfiles.log_name(os.path.basename(path)[len(prefix):])
+            if host.startswith('full-'):
+                # The unfiltered events, see target/events-filter
+                continue
+            result.append(read_source(path, '{} {}'.format(host, kind), clock_offsets.get(host, 0.0), order))
+    return result
+
+
+def read_clock_offsets(logdir):
+    path = os.path.join(logdir, 'clock-offsets.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_timeline(logdir, out):
+    """ Write the merged timeline of logdir to the file object out. Returns the number of lines. """
+    count = 0
+    for timestamp, _, _, label, text in heapq.merge(*sources(logdir, read_clock_offsets(logdir))):
+        out.write('{} {}: {}\n'.format(
+            datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat(timespec='microseconds'),
+            label, text))
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the logs of a test run into one timeline')
+    parser.add_argument('logdir', help='log directory of the test run')
+    parser.add_argument('-o', '--output', help='output file; defaults to timeline.log in the log directory')
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(args.logdir, 'timeline.log')
+    with open(output, 'w', encoding='utf-8') as out:
+        count = write_timeline(args.logdir, out)
+    print('Wrote {} lines to {}'.format(count, output))
+
+
+if __name__ == '__main__':
+    main()
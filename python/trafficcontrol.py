@@ -1,4 +1,3 @@
-from subprocess import CalledProcessError
 from .drbdtest import log
 
 
@@ -15,35 +14,38 @@ class TrafficControl(object):
         self.source_node = source_node
         self.nodes = nodes
 
-        for dev, (net_num, nodes) in self._get_nodes_by_dev().items():
-            # Clear away any leftover mess
-            try:
-                self.source_node.run(['tc', 'qdisc', 'del', 'dev', dev, 'root'])
-            except CalledProcessError:
-                pass # The command fails when nothing is configured
-
-            self.source_node.run(['tc', 'qdisc', 'replace', 'dev', dev,
-                'root',
-                'handle', '1:',
-                # Use the 'prio' classful qdisc. We do not care about prioritization. We just need some classes.
-                'prio',
-                'bands', len(self.nodes),
-                # Send all unfiltered packets to band 'self.id', where no rate limiting will be applied.
-                'priomap'] + [str(self.source_node.id)] * 16)
-
-            for node in nodes:
-                ip = node.host.addrs[net_num]
-                log('Traffic control for net {0} from {1} to {2} uses {3} ({4})'
-                        .format(net_num, self.source_node, node, dev, ip))
-
-                # Filter packets to the destination IP and send them to the corresponding class.
-                self.source_node.run(['tc', 'filter', 'add', 'dev', dev,
-                    'parent', '1:',
-                    'protocol', 'ip',
-                    'prio', '1',
-                    'u32',
-                    'match', 'ip', 'dst', ip,
-                    'flowid', self._node_to_class(node)])
+        self.source_node.host.cache_routes(addr
+                for node in self.nodes if node != self.source_node
+                for addr in node.host.addrs)
+
+        with self.source_node.batch() as batch:
+            for dev, (net_num, nodes) in self._get_nodes_by_dev().items():
+                # Clear away any leftover mess. The command fails when nothing
+                # is configured.
+                batch.run(['tc', 'qdisc', 'del', 'dev', dev, 'root'], catch=True)
+
+                batch.run(['tc', 'qdisc', 'replace', 'dev', dev,
+                    'root',
+                    'handle', '1:',
+                    # Use the 'prio' classful qdisc. We do not care about prioritization. We just need some classes.
+                    'prio',
+                    'bands', len(self.nodes),
+                    # Send all unfiltered packets to band 'self.id', where no rate limiting will be applied.
+                    'priomap'] + [str(self.source_node.id)] * 16)
+
+                for node in nodes:
+                    ip = node.host.addrs[net_num]
+                    log('Traffic control for net {0} from {1} to {2} uses {3} ({4})'
+                            .format(net_num, self.source_node, node, dev, ip))
+
+                    # Filter packets to the destination IP and send them to the corresponding class.
+                    batch.run(['tc', 'filter', 'add', 'dev', dev,
+                        'parent', '1:',
+                        'protocol', 'ip',
+                        'prio', '1',
+                        'u32',
+                        'match', 'ip', 'dst', ip,
+                        'flowid', self._node_to_class(node)])
 
     def reset(self):
         for dev in self._get_nodes_by_dev():
@@ -39,6 +39,9 @@ class WindowsPlatformHelper(object):
         version_match = re.match(r'([0-9]+)\.([0-9]+)\.([0-9]+).*', host.drbd_version)
         host.drbd_version_tuple = int(version_match.group(1)), int(version_match.group(2)), int(version_match.group(3))
 
+    def invalidate_drbd_facts(self, host):
+        pass
+
     # /cygdrive/c/xxx -> C:\xxx
     # but also: /dev/sdc -> \\.\Volume{<guid>}
     #